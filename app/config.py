@@ -2,6 +2,7 @@
 应用配置模块
 使用 Pydantic Settings 管理配置
 """
+from pydantic import field_validator
 from pydantic_settings import BaseSettings, SettingsConfigDict
 from pathlib import Path
 
@@ -27,6 +28,8 @@ class Settings(BaseSettings):
     # 安全配置
     secret_key: str = "change-me-strong-secret"
     admin_password: str = "change-me"
+    bcrypt_rounds: int = 12
+    password_pepper: str = ""
 
     # 日志配置
     log_level: str = "INFO"
@@ -47,6 +50,14 @@ class Settings(BaseSettings):
     # 时区配置
     timezone: str = "Asia/Shanghai"
 
+    @field_validator("bcrypt_rounds")
+    @classmethod
+    def validate_bcrypt_rounds(cls, value: int) -> int:
+        """bcrypt 只接受 4-31 轮，启动时校验，避免到首次登录或修改密码时才报错"""
+        if not 4 <= value <= 31:
+            raise ValueError("bcrypt_rounds 必须在 4 到 31 之间")
+        return value
+
     model_config = SettingsConfigDict(
         env_file=BASE_DIR / ".env",
         env_file_encoding="utf-8",
@@ -2,19 +2,93 @@
 数据库连接模块
 SQLite 异步连接配置和会话管理
 """
-from sqlalchemy import text
+import asyncio
+import functools
+import logging
+from sqlalchemy import event
+from sqlalchemy.exc import OperationalError
 from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession, async_sessionmaker
 from sqlalchemy.orm import declarative_base
 from app.config import settings
 
+logger = logging.getLogger(__name__)
+
+# 等待其他连接释放写锁的最长时间 (秒)
+SQLITE_BUSY_TIMEOUT = 30
+
 # 创建异步引擎
 engine = create_async_engine(
     settings.database_url,
     echo=settings.debug,  # 开发环境打印 SQL
     future=True,
-    connect_args={"timeout": 30}
+    connect_args={"timeout": SQLITE_BUSY_TIMEOUT}
 )
 
+# 每个连接建立时执行的 SQLite PRAGMA
+SQLITE_PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    # 同时作用于迁移脚本直接创建的 sqlite3 连接
+    f"PRAGMA busy_timeout={SQLITE_BUSY_TIMEOUT * 1000}",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA cache_size=-64000",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA mmap_size=268435456",
+)
+
+
+def apply_sqlite_pragmas(dbapi_conn):
+    """
+    在 DBAPI 连接上应用 SQLite PRAGMA
+    供连接池事件和迁移脚本共用
+    """
+    cursor = dbapi_conn.cursor()
+    try:
+        for pragma in SQLITE_PRAGMAS:
+            cursor.execute(pragma)
+    finally:
+        cursor.close()
+
+
+@event.listens_for(engine.sync_engine, "connect")
+def _set_sqlite_pragmas(dbapi_conn, connection_record):
+    """连接池中每个新连接都继承同样的 PRAGMA 设置"""
+    apply_sqlite_pragmas(dbapi_conn)
+
+
+# 数据库被锁定时的最大重试次数和首次退避时间 (秒)
+LOCK_MAX_RETRIES = 3
+LOCK_RETRY_BASE_DELAY = 0.1
+
+
+def is_database_locked(exc: BaseException) -> bool:
+    """判断异常是否为 SQLite 的 "database is locked" 错误"""
+    return isinstance(exc, OperationalError) and "locked" in str(exc).lower()
+
+
+def lock_retry_delay(attempt: int) -> float:
+    """第 attempt 次 (从 0 开始) 重试前的指数退避时间"""
+    return LOCK_RETRY_BASE_DELAY * (2 ** attempt)
+
+
+def retry_on_database_locked(func):
+    """
+    装饰异步函数，遇到 "database is locked" 时按指数退避重试
+    被装饰的函数需自行保证重试安全 (例如每次都在新事务中执行)
+    """
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        for attempt in range(LOCK_MAX_RETRIES + 1):
+            try:
+                return await func(*args, **kwargs)
+            except OperationalError as e:
+                if not is_database_locked(e) or attempt == LOCK_MAX_RETRIES:
+                    raise
+                delay = lock_retry_delay(attempt)
+                logger.warning(f"数据库被锁定，{delay:.1f} 秒后重试 {func.__qualname__} ({attempt + 1}/{LOCK_MAX_RETRIES})")
+                await asyncio.sleep(delay)
+    return wrapper
+
+
 # 创建异步会话工厂
 AsyncSessionLocal = async_sessionmaker(
     engine,
@@ -40,16 +114,41 @@ async def get_db() -> AsyncSession:
             await session.close()
 
 
+async def get_readonly_db() -> AsyncSession:
+    """
+    获取只读查询使用的数据库会话
+    连接以 AUTOCOMMIT 模式运行，查询不会开启事务，也就不会持有或升级为写锁
+    用于 FastAPI 依赖注入，仅适用于不修改数据的接口
+    """
+    async with AsyncSessionLocal() as session:
+        try:
+            await session.connection(execution_options={"isolation_level": "AUTOCOMMIT"})
+            yield session
+        finally:
+            await session.close()
+
+
 async def init_db():
     """
     初始化数据库
     创建所有表
     """
     async with engine.begin() as conn:
-        await conn.execute(text("PRAGMA journal_mode=WAL"))
         await conn.run_sync(Base.metadata.create_all)
 
 
+async def run_pragma_optimize():
+    """
+    执行 PRAGMA optimize
+    让 SQLite 根据运行期间的查询情况更新索引统计信息
+    """
+    try:
+        async with engine.connect() as conn:
+            await conn.exec_driver_sql("PRAGMA optimize")
+    except Exception as e:
+        logger.warning(f"PRAGMA optimize 执行失败: {e}")
+
+
 async def close_db():
     """
     关闭数据库连接
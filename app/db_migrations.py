@@ -2,6 +2,7 @@
 数据库自动迁移模块
 在应用启动时自动检测并执行必要的数据库迁移
 """
+import functools
 import logging
 import sqlite3
 from pathlib import Path
@@ -10,6 +11,181 @@ from datetime import datetime
 logger = logging.getLogger(__name__)
 
 
+# 当前代码对应的数据库结构版本
+CURRENT_SCHEMA_VERSION = 11
+
+
+def backfill_audit_created_at(cursor):
+    """
+    为 created_at 为空的审计日志补齐时间
+    使用应用配置时区的当前时间，格式与 ORM 写入的值一致，保证按 (created_at, id) 排序正确
+    """
+    from app.utils.time_utils import get_now
+    cursor.execute(
+        "UPDATE audit_logs SET created_at = ? WHERE created_at IS NULL",
+        (get_now().strftime("%Y-%m-%d %H:%M:%S.%f"),)
+    )
+
+# 保持 audit_logs_fts 与 audit_logs 同步的触发器
+AUDIT_FTS_TRIGGERS = [
+    """
+    CREATE TRIGGER IF NOT EXISTS audit_logs_fts_ai AFTER INSERT ON audit_logs BEGIN
+        INSERT INTO audit_logs_fts (rowid, actor, message)
+        VALUES (new.id, new.actor, new.message);
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS audit_logs_fts_ad AFTER DELETE ON audit_logs BEGIN
+        INSERT INTO audit_logs_fts (audit_logs_fts, rowid, actor, message)
+        VALUES ('delete', old.id, old.actor, old.message);
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS audit_logs_fts_au AFTER UPDATE ON audit_logs BEGIN
+        INSERT INTO audit_logs_fts (audit_logs_fts, rowid, actor, message)
+        VALUES ('delete', old.id, old.actor, old.message);
+        INSERT INTO audit_logs_fts (rowid, actor, message)
+        VALUES (new.id, new.actor, new.message);
+    END
+    """,
+]
+
+# 迁移列表: (版本号, [(迁移目标, [SQL, ...]), ...])
+# 迁移目标为 "表名.列名" 时检查列是否存在，为 "表名"/"索引名" 时检查表或索引是否存在，
+# 已存在则跳过 (新库由 create_all 直接建出完整结构)；为 None 时无条件执行 (仅靠版本号保证只执行一次)
+MIGRATIONS = [
+    (1, [
+        ("redemption_codes.has_warranty", [
+            "ALTER TABLE redemption_codes ADD COLUMN has_warranty BOOLEAN DEFAULT 0"
+        ]),
+        ("redemption_codes.warranty_expires_at", [
+            "ALTER TABLE redemption_codes ADD COLUMN warranty_expires_at DATETIME"
+        ]),
+        ("redemption_codes.warranty_days", [
+            "ALTER TABLE redemption_codes ADD COLUMN warranty_days INTEGER DEFAULT 30"
+        ]),
+    ]),
+    (2, [
+        ("redemption_records.is_warranty_redemption", [
+            "ALTER TABLE redemption_records ADD COLUMN is_warranty_redemption BOOLEAN DEFAULT 0"
+        ]),
+    ]),
+    # Token 刷新相关字段
+    (3, [
+        ("teams.refresh_token_encrypted", [
+            "ALTER TABLE teams ADD COLUMN refresh_token_encrypted TEXT"
+        ]),
+        ("teams.session_token_encrypted", [
+            "ALTER TABLE teams ADD COLUMN session_token_encrypted TEXT"
+        ]),
+    ]),
+    (4, [
+        ("teams.client_id", [
+            "ALTER TABLE teams ADD COLUMN client_id VARCHAR(100)"
+        ]),
+    ]),
+    (5, [
+        ("audit_logs", [
+            """
+            CREATE TABLE audit_logs (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                actor VARCHAR(100),
+                action VARCHAR(100) NOT NULL,
+                target_type VARCHAR(50),
+                target_id VARCHAR(100),
+                message TEXT,
+                ip VARCHAR(64),
+                created_at DATETIME
+            )
+            """,
+            "CREATE INDEX IF NOT EXISTS idx_audit_created ON audit_logs (created_at)",
+            "CREATE INDEX IF NOT EXISTS idx_audit_action ON audit_logs (action)",
+        ]),
+    ]),
+    (6, [
+        ("teams.error_count", [
+            "ALTER TABLE teams ADD COLUMN error_count INTEGER DEFAULT 0"
+        ]),
+    ]),
+    # 审计日志游标分页
+    (7, [
+        ("idx_audit_created_id", [
+            "CREATE INDEX IF NOT EXISTS idx_audit_created_id ON audit_logs (created_at DESC, id DESC)"
+        ]),
+    ]),
+    # 审计日志全文索引 (trigram 分词支持任意子串 LIKE 查询走索引)，由触发器保持同步
+    (8, [
+        ("audit_logs_fts", [
+            """
+            CREATE VIRTUAL TABLE audit_logs_fts USING fts5(
+                actor, message,
+                content='audit_logs', content_rowid='id', tokenize='trigram'
+            )
+            """,
+            *AUDIT_FTS_TRIGGERS,
+            "INSERT INTO audit_logs_fts (audit_logs_fts) VALUES ('rebuild')",
+        ]),
+    ]),
+    # 审计日志按动作/目标类型筛选并按时间倒序的组合索引，替代单列 action 索引
+    (9, [
+        ("idx_audit_action_created", [
+            "CREATE INDEX IF NOT EXISTS idx_audit_action_created ON audit_logs (action, created_at DESC)",
+            "DROP INDEX IF EXISTS idx_audit_action",
+        ]),
+        ("idx_audit_target_created", [
+            "CREATE INDEX IF NOT EXISTS idx_audit_target_created ON audit_logs (target_type, created_at DESC)"
+        ]),
+    ]),
+    # audit_logs.created_at 改为 NOT NULL
+    # SQLite 不支持修改列约束，需重建表；保留原 id 以便全文索引继续对应
+    # 不使用 DEFAULT CURRENT_TIMESTAMP: 它写入 UTC 时间，而应用按配置时区写入本地时间
+    (10, [
+        (None, [
+            backfill_audit_created_at,
+            """
+            CREATE TABLE audit_logs_new (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                actor VARCHAR(100),
+                action VARCHAR(100) NOT NULL,
+                target_type VARCHAR(50),
+                target_id VARCHAR(100),
+                message TEXT,
+                ip VARCHAR(64),
+                created_at DATETIME NOT NULL
+            )
+            """,
+            """
+            INSERT INTO audit_logs_new (id, actor, action, target_type, target_id, message, ip, created_at)
+            SELECT id, actor, action, target_type, target_id, message, ip, created_at
+            FROM audit_logs
+            """,
+            "DROP TABLE audit_logs",
+            "ALTER TABLE audit_logs_new RENAME TO audit_logs",
+            "CREATE INDEX idx_audit_created ON audit_logs (created_at)",
+            "CREATE INDEX idx_audit_created_id ON audit_logs (created_at DESC, id DESC)",
+            "CREATE INDEX idx_audit_action_created ON audit_logs (action, created_at DESC)",
+            "CREATE INDEX idx_audit_target_created ON audit_logs (target_type, created_at DESC)",
+            *AUDIT_FTS_TRIGGERS,
+        ]),
+    ]),
+    # 兑换/质保热点查询的组合索引，替代对应的单列索引
+    (11, [
+        ("idx_team_status_expires", [
+            "CREATE INDEX IF NOT EXISTS idx_team_status_expires ON teams (status, expires_at)",
+            "DROP INDEX IF EXISTS idx_status",
+        ]),
+        ("idx_record_email_redeemed", [
+            "CREATE INDEX IF NOT EXISTS idx_record_email_redeemed ON redemption_records (email, redeemed_at DESC)",
+            "DROP INDEX IF EXISTS idx_email",
+        ]),
+        ("idx_record_code_redeemed", [
+            "CREATE INDEX IF NOT EXISTS idx_record_code_redeemed ON redemption_records (code, redeemed_at DESC)"
+        ]),
+    ]),
+]
+
+
+@functools.lru_cache(maxsize=1)
 def get_db_path():
     """获取数据库文件路径"""
     from app.config import settings
@@ -17,17 +193,42 @@ def get_db_path():
     return Path(db_file)
 
 
-def table_exists(cursor, table_name):
-    """Check if table exists"""
-    cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name=?", (table_name,))
-    return cursor.fetchone() is not None
+def load_existing_objects(cursor):
+    """一次性读取所有已存在的表名和索引名"""
+    cursor.execute("SELECT name FROM sqlite_master WHERE type IN ('table', 'index')")
+    return {row[0] for row in cursor.fetchall()}
+
+
+def load_existing_columns(cursor, tables):
+    """
+    一次性读取指定表的所有列
+    使用 pragma_table_info 表值函数，替代逐列执行 PRAGMA table_info
+
+    Returns:
+        {(表名, 列名)} 集合
+    """
+    placeholders = ", ".join("?" for _ in tables)
+    cursor.execute(
+        f"""
+        SELECT m.name, p.name
+        FROM sqlite_master m, pragma_table_info(m.name) p
+        WHERE m.type = 'table' AND m.name IN ({placeholders})
+        """,
+        tuple(tables)
+    )
+    return {(row[0], row[1]) for row in cursor.fetchall()}
 
 
-def column_exists(cursor, table_name, column_name):
-    """检查表中是否存在指定列"""
-    cursor.execute(f"PRAGMA table_info({table_name})")
-    columns = [row[1] for row in cursor.fetchall()]
-    return column_name in columns
+def get_schema_version(cursor):
+    """读取已应用的最大迁移版本号，版本表不存在时先创建"""
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS schema_migrations (
+            version INTEGER PRIMARY KEY,
+            applied_at DATETIME
+        )
+    """)
+    cursor.execute("SELECT COALESCE(MAX(version), 0) FROM schema_migrations")
+    return cursor.fetchone()[0]
 
 
 def run_auto_migration():
@@ -35,103 +236,103 @@ def run_auto_migration():
     自动运行数据库迁移
     检测缺失的列并自动添加
     """
+    from app.database import apply_sqlite_pragmas
+
     db_path = get_db_path()
-    
+
     if not db_path.exists():
         logger.info("数据库文件不存在，跳过迁移")
         return
-    
+
     logger.info("开始检查数据库迁移...")
-    
+
+    conn = None
     try:
-        conn = sqlite3.connect(str(db_path))
+        # isolation_level=None 关闭隐式事务，由下方显式 BEGIN/COMMIT 控制，
+        # 所有探测和 DDL 合并在一个事务中，只触发一次日志刷盘
+        conn = sqlite3.connect(str(db_path), isolation_level=None)
         cursor = conn.cursor()
-        
+
+        # 快速路径: user_version 存于数据库文件头，一次 PRAGMA 读取即可判断是否需要迁移
+        cursor.execute("PRAGMA user_version")
+        if cursor.fetchone()[0] >= CURRENT_SCHEMA_VERSION:
+            logger.info("数据库已是最新版本，无需迁移")
+            conn.close()
+            return
+
+        # 与连接池使用同一套 PRAGMA；journal_mode 无法在事务内切换，必须在 BEGIN 之前设置
+        apply_sqlite_pragmas(conn)
+
+        # 版本已是最新时直接返回，不再扫描表结构 (兼容尚未写入 user_version 的数据库)
+        if get_schema_version(cursor) >= CURRENT_SCHEMA_VERSION:
+            cursor.execute(f"PRAGMA user_version = {CURRENT_SCHEMA_VERSION}")
+            logger.info("数据库已是最新版本，无需迁移")
+            conn.close()
+            return
+
+        cursor.execute("BEGIN IMMEDIATE")
+
+        # 在写锁内重新读取版本，避免多进程同时启动时重复迁移
+        current_version = get_schema_version(cursor)
+        pending = [m for m in MIGRATIONS if m[0] > current_version]
+
         migrations_applied = []
-        
-        # 检查并添加质保相关字段
-        if not column_exists(cursor, "redemption_codes", "has_warranty"):
-            logger.info("添加 redemption_codes.has_warranty 字段")
-            cursor.execute("""
-                ALTER TABLE redemption_codes 
-                ADD COLUMN has_warranty BOOLEAN DEFAULT 0
-            """)
-            migrations_applied.append("redemption_codes.has_warranty")
-        
-        if not column_exists(cursor, "redemption_codes", "warranty_expires_at"):
-            logger.info("添加 redemption_codes.warranty_expires_at 字段")
-            cursor.execute("""
-                ALTER TABLE redemption_codes 
-                ADD COLUMN warranty_expires_at DATETIME
-            """)
-            migrations_applied.append("redemption_codes.warranty_expires_at")
-        
-        if not column_exists(cursor, "redemption_codes", "warranty_days"):
-            logger.info("添加 redemption_codes.warranty_days 字段")
-            cursor.execute("""
-                ALTER TABLE redemption_codes 
-                ADD COLUMN warranty_days INTEGER DEFAULT 30
-            """)
-            migrations_applied.append("redemption_codes.warranty_days")
-        
-        if not column_exists(cursor, "redemption_records", "is_warranty_redemption"):
-            logger.info("添加 redemption_records.is_warranty_redemption 字段")
-            cursor.execute("""
-                ALTER TABLE redemption_records 
-                ADD COLUMN is_warranty_redemption BOOLEAN DEFAULT 0
-            """)
-            migrations_applied.append("redemption_records.is_warranty_redemption")
-
-        # 检查并添加 Token 刷新相关字段
-        if not column_exists(cursor, "teams", "refresh_token_encrypted"):
-            logger.info("添加 teams.refresh_token_encrypted 字段")
-            cursor.execute("ALTER TABLE teams ADD COLUMN refresh_token_encrypted TEXT")
-            migrations_applied.append("teams.refresh_token_encrypted")
-
-        if not column_exists(cursor, "teams", "session_token_encrypted"):
-            logger.info("添加 teams.session_token_encrypted 字段")
-            cursor.execute("ALTER TABLE teams ADD COLUMN session_token_encrypted TEXT")
-            migrations_applied.append("teams.session_token_encrypted")
-
-        if not column_exists(cursor, "teams", "client_id"):
-            logger.info("添加 teams.client_id 字段")
-            cursor.execute("ALTER TABLE teams ADD COLUMN client_id VARCHAR(100)")
-            migrations_applied.append("teams.client_id")
-
-        if not table_exists(cursor, "audit_logs"):
-            logger.info("Create audit_logs table")
-            cursor.execute("""
-                CREATE TABLE audit_logs (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    actor VARCHAR(100),
-                    action VARCHAR(100) NOT NULL,
-                    target_type VARCHAR(50),
-                    target_id VARCHAR(100),
-                    message TEXT,
-                    ip VARCHAR(64),
-                    created_at DATETIME
-                )
-            """)
-            cursor.execute("CREATE INDEX IF NOT EXISTS idx_audit_created ON audit_logs (created_at)")
-            cursor.execute("CREATE INDEX IF NOT EXISTS idx_audit_action ON audit_logs (action)")
-            migrations_applied.append("audit_logs")
-
-        if not column_exists(cursor, "teams", "error_count"):
-            logger.info("添加 teams.error_count 字段")
-            cursor.execute("ALTER TABLE teams ADD COLUMN error_count INTEGER DEFAULT 0")
-            migrations_applied.append("teams.error_count")
-        
+
+        existing_objects = load_existing_objects(cursor)
+        existing_cols = load_existing_columns(
+            cursor, ("redemption_codes", "redemption_records", "teams")
+        )
+
+        for version, steps in pending:
+            for target, statements in steps:
+                if target is None:
+                    exists = False
+                elif "." in target:
+                    exists = tuple(target.split(".", 1)) in existing_cols
+                else:
+                    exists = target in existing_objects
+                if exists:
+                    continue
+
+                label = f"v{version}: {target}" if target else f"v{version}"
+                logger.info(f"应用迁移 {label}")
+                for sql in statements:
+                    # 需要在 Python 中计算参数的步骤以函数形式给出
+                    if callable(sql):
+                        sql(cursor)
+                    else:
+                        cursor.execute(sql)
+                migrations_applied.append(target or f"v{version}")
+
+            cursor.execute(
+                "INSERT OR IGNORE INTO schema_migrations (version, applied_at) VALUES (?, ?)",
+                (version, datetime.now().isoformat(sep=" "))
+            )
+
+        cursor.execute(f"PRAGMA user_version = {CURRENT_SCHEMA_VERSION}")
+
         # 提交更改
-        conn.commit()
-        
+        cursor.execute("COMMIT")
+
         if migrations_applied:
             logger.info(f"数据库迁移完成，应用了 {len(migrations_applied)} 个迁移: {', '.join(migrations_applied)}")
         else:
             logger.info("数据库已是最新版本，无需迁移")
-        
+
+        # 新建索引后刷新统计信息，让查询规划器立即选用正确的索引
+        try:
+            cursor.execute("PRAGMA optimize")
+        except sqlite3.OperationalError:
+            pass
+
         conn.close()
-        
+
     except Exception as e:
+        # 回滚未完成的迁移，避免留下部分变更
+        if conn is not None:
+            if conn.in_transaction:
+                conn.execute("ROLLBACK")
+            conn.close()
         logger.error(f"数据库迁移失败: {e}")
         raise
 
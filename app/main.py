@@ -16,9 +16,11 @@ from contextlib import asynccontextmanager
 # 导入路由
 from app.routes import redeem, auth, admin, api, user, warranty
 from app.config import settings
-from app.database import init_db, close_db, AsyncSessionLocal
+from app.database import init_db, close_db, run_pragma_optimize, AsyncSessionLocal
 from app.services.auth import auth_service
-from app.services.team import TeamService
+from app.services.audit import audit_sink
+from app.services.team import team_service
+from app.services.warranty import warranty_service
 
 # 获取项目根目录
 BASE_DIR = Path(__file__).resolve().parent.parent
@@ -26,8 +28,6 @@ APP_DIR = BASE_DIR / "app"
 
 from starlette.exceptions import HTTPException as StarletteHTTPException
 
-team_service = TeamService()
-
 _sync_task = None
 
 async def periodic_sync():
@@ -72,10 +72,20 @@ async def lifespan(app: FastAPI):
         logger.info("数据库初始化完成")
     except Exception as e:
         logger.error(f"数据库初始化失败: {e}")
+
+    # 启动审计日志批量写入任务
+    audit_sink.start()
     
     yield
     
-    # 关闭连接
+    # 取消质保查询触发的后台同步任务
+    await warranty_service.shutdown()
+
+    # 写入剩余的审计日志
+    await audit_sink.stop()
+
+    # 更新查询统计信息后关闭连接
+    await run_pragma_optimize()
     await close_db()
     logger.info("系统正在关闭，已释放数据库连接")
 
@@ -38,7 +38,8 @@ class Team(Base):
 
     # 索引
     __table_args__ = (
-        Index("idx_status", "status"),
+        # 按状态筛选并按到期时间排序 (自动选择 Team)
+        Index("idx_team_status_expires", "status", "expires_at"),
     )
 
 
@@ -105,7 +106,8 @@ class RedemptionRecord(Base):
 
     # 索引
     __table_args__ = (
-        Index("idx_email", "email"),
+        Index("idx_record_email_redeemed", "email", redeemed_at.desc()),
+        Index("idx_record_code_redeemed", "code", redeemed_at.desc()),
     )
 
 
@@ -120,11 +122,13 @@ class AuditLog(Base):
     target_id = Column(String(100), comment="??ID")
     message = Column(Text, comment="????")
     ip = Column(String(64), comment="IP??")
-    created_at = Column(DateTime, default=get_now, comment="????")
+    created_at = Column(DateTime, nullable=False, default=get_now, comment="????")
 
     __table_args__ = (
         Index("idx_audit_created", "created_at"),
-        Index("idx_audit_action", "action"),
+        Index("idx_audit_created_id", created_at.desc(), id.desc()),
+        Index("idx_audit_action_created", action, created_at.desc()),
+        Index("idx_audit_target_created", target_type, created_at.desc()),
     )
 
 
@@ -13,8 +13,8 @@ from pydantic import BaseModel, Field
 
 from app.database import get_db
 from app.dependencies.auth import require_admin
-from app.services.team import TeamService
-from app.services.redemption import RedemptionService
+from app.services.team import team_service
+from app.services.redemption import redemption_service
 from app.services.audit import audit_service
 from app.utils.time_utils import get_now
 
@@ -29,10 +29,6 @@ router = APIRouter(
 import json
 from datetime import datetime
 
-# 服务实例
-team_service = TeamService()
-redemption_service = RedemptionService()
-
 
 def _get_client_ip(request: Request) -> str:
     forwarded = request.headers.get("x-forwarded-for") if request else None
@@ -1352,6 +1348,7 @@ async def audit_logs_page(
     actor: Optional[str] = None,
     action: Optional[str] = None,
     target_type: Optional[str] = None,
+    cursor: Optional[str] = None,
     db: AsyncSession = Depends(get_db),
     current_user: dict = Depends(require_admin)
 ):
@@ -1363,7 +1360,8 @@ async def audit_logs_page(
             per_page=50,
             actor=actor,
             action=action,
-            target_type=target_type
+            target_type=target_type,
+            after=audit_service.parse_cursor(cursor)
         )
         logs = logs_result.get("logs", [])
         return templates.TemplateResponse(
@@ -1380,9 +1378,11 @@ async def audit_logs_page(
                 },
                 "pagination": {
                     "current_page": logs_result.get("current_page", page),
-                    "total_pages": logs_result.get("total_pages", 1),
-                    "total": logs_result.get("total", 0),
-                    "per_page": 50
+                    "total_pages": logs_result.get("total_pages"),
+                    # 未统计总数时为 None，页面不显示条数
+                    "total": logs_result.get("total"),
+                    "per_page": 50,
+                    "next_cursor": logs_result.get("next_cursor")
                 }
             }
         )
@@ -9,7 +9,7 @@ from sqlalchemy.ext.asyncio import AsyncSession
 
 from app.database import get_db
 from app.dependencies.auth import get_current_user
-from app.services.team import TeamService
+from app.services.team import team_service
 
 logger = logging.getLogger(__name__)
 
@@ -19,9 +19,6 @@ router = APIRouter(
     tags=["api"]
 )
 
-# 服务实例
-team_service = TeamService()
-
 
 @router.get("/teams/{team_id}/refresh")
 async def refresh_team(
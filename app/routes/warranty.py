@@ -7,7 +7,7 @@ from pydantic import BaseModel, EmailStr
 from typing import Optional
 from sqlalchemy.ext.asyncio import AsyncSession
 
-from app.database import get_db
+from app.database import get_readonly_db
 from app.services.warranty import warranty_service
 
 router = APIRouter(
@@ -54,7 +54,7 @@ class WarrantyCheckResponse(BaseModel):
 @router.post("/check", response_model=WarrantyCheckResponse)
 async def check_warranty(
     request: WarrantyCheckRequest,
-    db_session: AsyncSession = Depends(get_db)
+    db_session: AsyncSession = Depends(get_readonly_db)
 ):
     """
     检查质保状态
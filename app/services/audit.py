@@ -1,19 +1,116 @@
 """
 Audit log service
 """
+import asyncio
 import logging
-from typing import Optional, Dict, Any
-from sqlalchemy import select, func, and_
+from datetime import datetime
+from typing import Optional, Dict, Any, List, Tuple
+from sqlalchemy import select, func, and_, or_, insert, table, column
 from sqlalchemy.ext.asyncio import AsyncSession
 
+from app.database import AsyncSessionLocal, retry_on_database_locked
 from app.models import AuditLog
+from app.utils.time_utils import get_now
 
 logger = logging.getLogger(__name__)
 
 
+class AuditSink:
+    """
+    Buffers audit rows in memory and writes them in batches.
+
+    A background task pulls up to ``batch_size`` rows (or whatever arrives
+    within ``flush_interval`` seconds) and inserts them in one transaction,
+    so audit-heavy requests no longer pay a commit per event.
+    """
+
+    def __init__(self, batch_size: int = 200, flush_interval: float = 0.05):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._queue: Optional[asyncio.Queue] = None
+        self._task: Optional[asyncio.Task] = None
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    def start(self) -> None:
+        if self.running:
+            return
+        self._queue = asyncio.Queue()
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        """Flush pending rows and stop the background task"""
+        if not self.running:
+            return
+        # None acts as a shutdown sentinel; rows queued before it are still written
+        await self._queue.put(None)
+        await self._task
+        self._task = None
+
+    async def put(self, row: Dict[str, Any]) -> None:
+        await self._queue.put(row)
+
+    async def _run(self) -> None:
+        loop = asyncio.get_running_loop()
+        stopping = False
+        while not stopping:
+            row = await self._queue.get()
+            if row is None:
+                break
+            batch = [row]
+            deadline = loop.time() + self.flush_interval
+            while len(batch) < self.batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    row = await asyncio.wait_for(self._queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+                if row is None:
+                    stopping = True
+                    break
+                batch.append(row)
+            await self._write(batch)
+
+    async def _write(self, rows: List[Dict[str, Any]]) -> None:
+        try:
+            await self._insert(rows)
+        except Exception as e:
+            if len(rows) == 1:
+                logger.error(f"Failed to write audit log: {e}")
+                return
+            # Fall back to one row per transaction so a single bad row (or a
+            # lock that outlasted the retries) does not drop the whole batch
+            logger.warning(f"Failed to write {len(rows)} audit logs as a batch, retrying row by row: {e}")
+            for row in rows:
+                try:
+                    await self._insert([row])
+                except Exception as row_error:
+                    logger.error(f"Failed to write audit log ({row.get('action')}): {row_error}")
+
+    @retry_on_database_locked
+    async def _insert(self, rows: List[Dict[str, Any]]) -> None:
+        async with AsyncSessionLocal() as session:
+            await session.execute(insert(AuditLog), rows)
+            await session.commit()
+
+
+audit_sink = AuditSink()
+
+# FTS5 (trigram) mirror of audit_logs.actor/message, maintained by triggers
+# created in db_migrations; LIKE '%x%' on it is served by the trigram index
+audit_logs_fts = table("audit_logs_fts", column("rowid"), column("actor"), column("message"))
+
+
 class AuditService:
     """Audit logging service"""
 
+    def __init__(self, sink: AuditSink = audit_sink):
+        self.sink = sink
+
     async def log_action(
         self,
         db_session: AsyncSession,
@@ -24,21 +121,67 @@ class AuditService:
         message: Optional[str] = None,
         ip: Optional[str] = None
     ) -> None:
+        row = {
+            "actor": actor,
+            "action": action,
+            "target_type": target_type,
+            "target_id": target_id,
+            "message": message,
+            "ip": ip,
+            "created_at": get_now()
+        }
+
+        if self.sink.running:
+            await self.sink.put(row)
+            return
+
+        # Sink not started (e.g. scripts outside the app lifespan): write directly
         try:
-            log = AuditLog(
-                actor=actor,
-                action=action,
-                target_type=target_type,
-                target_id=target_id,
-                message=message,
-                ip=ip
-            )
-            db_session.add(log)
+            db_session.add(AuditLog(**row))
             await db_session.commit()
         except Exception as e:
             await db_session.rollback()
             logger.error(f"Failed to write audit log: {e}")
 
+    @staticmethod
+    def parse_cursor(cursor: Optional[str]) -> Optional[Tuple[datetime, int]]:
+        """Parse a "created_at,id" cursor string, returning None if invalid"""
+        if not cursor:
+            return None
+        try:
+            created_at, log_id = cursor.rsplit(",", 1)
+            return datetime.fromisoformat(created_at), int(log_id)
+        except ValueError:
+            return None
+
+    @staticmethod
+    def _log_to_dict(log: AuditLog) -> Dict[str, Any]:
+        return {
+            "id": log.id,
+            "actor": log.actor,
+            "action": log.action,
+            "target_type": log.target_type,
+            "target_id": log.target_id,
+            "message": log.message,
+            "ip": log.ip,
+            "created_at": log.created_at.isoformat()
+        }
+
+    @staticmethod
+    def _next_cursor(log_list: List[Dict[str, Any]], has_more: bool) -> Optional[str]:
+        """Build the keyset cursor after the last row, or None when no rows follow."""
+        if not has_more or not log_list:
+            return None
+        last = log_list[-1]
+        return f"{last['created_at']},{last['id']}"
+
+    @staticmethod
+    async def _count(db_session: AsyncSession, filters: List[Any]) -> int:
+        count_stmt = select(func.count(AuditLog.id))
+        if filters:
+            count_stmt = count_stmt.where(and_(*filters))
+        return (await db_session.execute(count_stmt)).scalar() or 0
+
     async def get_logs(
         self,
         db_session: AsyncSession,
@@ -46,48 +189,97 @@ class AuditService:
         per_page: int = 50,
         actor: Optional[str] = None,
         action: Optional[str] = None,
-        target_type: Optional[str] = None
+        target_type: Optional[str] = None,
+        message: Optional[str] = None,
+        after: Optional[Tuple[datetime, int]] = None,
+        include_total: bool = True
     ) -> Dict[str, Any]:
+        """
+        Return a page of audit logs, newest first.
+
+        When ``after`` (created_at, id of the last row seen) is given, keyset
+        pagination is used instead of OFFSET; ``page`` is then only echoed back
+        as ``current_page``. Every mode returns ``next_cursor`` when more rows
+        follow, so the next page can always be fetched by keyset.
+        ``include_total=False`` skips counting matching rows; ``total`` and
+        ``total_pages`` are then None.
+        """
         try:
-            stmt = select(AuditLog)
             filters = []
             if actor:
-                filters.append(AuditLog.actor.ilike(f"%{actor}%"))
+                filters.append(AuditLog.id.in_(
+                    select(audit_logs_fts.c.rowid).where(audit_logs_fts.c.actor.like(f"%{actor}%"))
+                ))
+            if message:
+                filters.append(AuditLog.id.in_(
+                    select(audit_logs_fts.c.rowid).where(audit_logs_fts.c.message.like(f"%{message}%"))
+                ))
             if action:
-                filters.append(AuditLog.action.ilike(f"%{action}%"))
+                # Case-insensitive substring match, so "redeem" also finds "code_redeem"
+                filters.append(AuditLog.action.ilike(f"%{action.strip()}%"))
             if target_type:
                 filters.append(AuditLog.target_type == target_type)
-            if filters:
-                stmt = stmt.where(and_(*filters))
 
-            count_stmt = select(func.count()).select_from(stmt.subquery())
-            count_result = await db_session.execute(count_stmt)
-            total = count_result.scalar() or 0
+            order_by = (AuditLog.created_at.desc(), AuditLog.id.desc())
 
-            import math
-            total_pages = math.ceil(total / per_page) if total > 0 else 1
             if page < 1:
                 page = 1
-            if page > total_pages and total_pages > 0:
-                page = total_pages
-            offset = (page - 1) * per_page
-
-            stmt = stmt.order_by(AuditLog.created_at.desc()).limit(per_page).offset(offset)
-            result = await db_session.execute(stmt)
-            logs = result.scalars().all()
-
-            log_list = []
-            for log in logs:
-                log_list.append({
-                    "id": log.id,
-                    "actor": log.actor,
-                    "action": log.action,
-                    "target_type": log.target_type,
-                    "target_id": log.target_id,
-                    "message": log.message,
-                    "ip": log.ip,
-                    "created_at": log.created_at.isoformat() if log.created_at else None
-                })
+
+            if after is not None or not include_total:
+                stmt = select(AuditLog)
+                if after is not None:
+                    after_created_at, after_id = after
+                    stmt = stmt.where(or_(
+                        AuditLog.created_at < after_created_at,
+                        and_(AuditLog.created_at == after_created_at, AuditLog.id < after_id)
+                    ))
+                else:
+                    stmt = stmt.offset((page - 1) * per_page)
+                if filters:
+                    stmt = stmt.where(and_(*filters))
+                # Fetch one extra row to know whether a next page exists
+                stmt = stmt.order_by(*order_by).limit(per_page + 1)
+                result = await db_session.execute(stmt)
+                logs = result.scalars().all()
+                log_list = [self._log_to_dict(log) for log in logs[:per_page]]
+
+                total = total_pages = None
+                if include_total:
+                    total = await self._count(db_session, filters)
+                    total_pages = (total + per_page - 1) // per_page if total else 1
+
+                return {
+                    "success": True,
+                    "logs": log_list,
+                    "total": total,
+                    "total_pages": total_pages,
+                    "current_page": page,
+                    "next_cursor": self._next_cursor(log_list, len(logs) > per_page),
+                    "error": None
+                }
+
+            # 通过窗口函数在同一次查询中返回总数和当前页数据
+            stmt = select(AuditLog, func.count().over().label("total_rows"))
+            if filters:
+                stmt = stmt.where(and_(*filters))
+            stmt = stmt.order_by(*order_by).limit(per_page)
+
+            result = await db_session.execute(stmt.offset((page - 1) * per_page))
+            rows = result.all()
+
+            if not rows and page > 1:
+                # 页码超出范围时窗口函数无法返回总数，直接对过滤条件计数后回退到最后一页
+                total = await self._count(db_session, filters)
+                if total > 0:
+                    page = (total + per_page - 1) // per_page
+                    result = await db_session.execute(stmt.offset((page - 1) * per_page))
+                    rows = result.all()
+                else:
+                    page = 1
+
+            total = rows[0].total_rows if rows else 0
+            total_pages = (total + per_page - 1) // per_page if total else 1
+            log_list = [self._log_to_dict(log) for log, _ in rows]
 
             return {
                 "success": True,
@@ -95,6 +287,8 @@ class AuditService:
                 "total": total,
                 "total_pages": total_pages,
                 "current_page": page,
+                # 下一页改用游标翻页，避免深页使用 OFFSET
+                "next_cursor": self._next_cursor(log_list, page < total_pages),
                 "error": None
             }
         except Exception as e:
@@ -2,14 +2,21 @@
 认证服务
 处理管理员登录、密码验证和 Session 管理
 """
+import asyncio
+import base64
+import hashlib
+import hmac
 import logging
+import time
 import bcrypt
-from typing import Optional, Dict, Any
+from typing import Optional, Dict, Any, Tuple
 from sqlalchemy import select
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 from sqlalchemy.ext.asyncio import AsyncSession
 
 from app.models import Setting
 from app.config import settings
+from app.utils.time_utils import get_now
 
 logger = logging.getLogger(__name__)
 
@@ -17,28 +24,56 @@ logger = logging.getLogger(__name__)
 class AuthService:
     """认证服务类"""
 
+    # 管理员密码哈希缓存有效期 (秒)
+    PASSWORD_HASH_CACHE_TTL = 30
+
+    # 预哈希格式的密码哈希前缀，无此前缀的为旧格式 bcrypt 哈希
+    PREHASH_PREFIX = "hmac-sha256$"
+
     def __init__(self):
         """初始化认证服务"""
-        pass
+        # (密码哈希, 缓存时间)
+        self._pw_cache: Optional[Tuple[str, float]] = None
+        self._pw_cache_lock = asyncio.Lock()
 
-    def hash_password(self, password: str) -> str:
+    def _prehash(self, password: str) -> bytes:
+        """
+        使用 HMAC-SHA256 (服务端 pepper) 预哈希密码
+        bcrypt 只处理前 72 字节，预哈希后输入固定为 44 字节，避免长密码被截断
+
+        Args:
+            password: 明文密码
+
+        Returns:
+            Base64 编码的摘要
+        """
+        digest = hmac.new(
+            settings.password_pepper.encode('utf-8'),
+            password.encode('utf-8'),
+            hashlib.sha256
+        ).digest()
+        return base64.b64encode(digest)
+
+    async def hash_password(self, password: str) -> str:
         """
         哈希密码
+        bcrypt 为 CPU 密集型操作，放到线程中执行以免阻塞事件循环
 
         Args:
             password: 明文密码
 
         Returns:
-            哈希后的密码
+            哈希后的密码 (带 PREHASH_PREFIX 前缀)
         """
-        password_bytes = password.encode('utf-8')
-        salt = bcrypt.gensalt()
-        hashed = bcrypt.hashpw(password_bytes, salt)
-        return hashed.decode('utf-8')
+        salt = bcrypt.gensalt(rounds=settings.bcrypt_rounds)
+        hashed = await asyncio.to_thread(bcrypt.hashpw, self._prehash(password), salt)
+        return self.PREHASH_PREFIX + hashed.decode('utf-8')
 
-    def verify_password(self, password: str, hashed_password: str) -> bool:
+    async def verify_password(self, password: str, hashed_password: str) -> bool:
         """
         验证密码
+        bcrypt 为 CPU 密集型操作，放到线程中执行以免阻塞事件循环
+        同时兼容未预哈希的旧格式 bcrypt 哈希
 
         Args:
             password: 明文密码
@@ -48,13 +83,42 @@ class AuthService:
             是否匹配
         """
         try:
-            password_bytes = password.encode('utf-8')
-            hashed_bytes = hashed_password.encode('utf-8')
-            return bcrypt.checkpw(password_bytes, hashed_bytes)
+            if hashed_password.startswith(self.PREHASH_PREFIX):
+                password_bytes = self._prehash(password)
+                hashed_bytes = hashed_password[len(self.PREHASH_PREFIX):].encode('utf-8')
+            else:
+                password_bytes = password.encode('utf-8')
+                hashed_bytes = hashed_password.encode('utf-8')
+            return await asyncio.to_thread(bcrypt.checkpw, password_bytes, hashed_bytes)
         except Exception as e:
             logger.error(f"密码验证失败: {e}")
             return False
 
+    def needs_rehash(self, hashed_password: str) -> bool:
+        """
+        判断密码哈希是否需要升级 (旧格式或 bcrypt 强度与配置不一致)
+
+        Args:
+            hashed_password: 哈希后的密码
+
+        Returns:
+            是否需要重新哈希
+        """
+        if not hashed_password.startswith(self.PREHASH_PREFIX):
+            return True
+        try:
+            # bcrypt 格式: $2b$<rounds>$<salt+hash>
+            rounds = int(hashed_password[len(self.PREHASH_PREFIX):].split("$")[2])
+        except (IndexError, ValueError):
+            return True
+        return rounds != settings.bcrypt_rounds
+
+    def _get_cached_password_hash(self) -> Optional[str]:
+        """返回未过期的缓存密码哈希"""
+        if self._pw_cache and time.monotonic() - self._pw_cache[1] < self.PASSWORD_HASH_CACHE_TTL:
+            return self._pw_cache[0]
+        return None
+
     async def get_admin_password_hash(self, db_session: AsyncSession) -> Optional[str]:
         """
         从数据库获取管理员密码哈希
@@ -65,14 +129,25 @@ class AuthService:
         Returns:
             密码哈希，如果不存在则返回 None
         """
+        cached = self._get_cached_password_hash()
+        if cached:
+            return cached
+
         try:
-            stmt = select(Setting).where(Setting.key == "admin_password_hash")
-            result = await db_session.execute(stmt)
-            setting = result.scalar_one_or_none()
+            # 加锁避免缓存过期时并发请求同时回源查询
+            async with self._pw_cache_lock:
+                cached = self._get_cached_password_hash()
+                if cached:
+                    return cached
 
-            if setting:
-                return setting.value
-            return None
+                stmt = select(Setting).where(Setting.key == "admin_password_hash")
+                result = await db_session.execute(stmt)
+                setting = result.scalar_one_or_none()
+
+                if setting and setting.value:
+                    self._pw_cache = (setting.value, time.monotonic())
+                    return setting.value
+                return None
 
         except Exception as e:
             logger.error(f"获取管理员密码哈希失败: {e}")
@@ -94,24 +169,19 @@ class AuthService:
             是否成功
         """
         try:
-            # 查询是否已存在
-            stmt = select(Setting).where(Setting.key == "admin_password_hash")
-            result = await db_session.execute(stmt)
-            setting = result.scalar_one_or_none()
-
-            if setting:
-                # 更新
-                setting.value = password_hash
-            else:
-                # 创建
-                setting = Setting(
-                    key="admin_password_hash",
-                    value=password_hash,
-                    description="管理员密码哈希"
-                )
-                db_session.add(setting)
+            # 单条 UPSERT: 不存在则插入，存在则更新
+            stmt = sqlite_insert(Setting).values(
+                key="admin_password_hash",
+                value=password_hash,
+                description="管理员密码哈希"
+            ).on_conflict_do_update(
+                index_elements=[Setting.key],
+                set_={"value": password_hash, "updated_at": get_now()}
+            )
+            await db_session.execute(stmt)
 
             await db_session.commit()
+            self._pw_cache = None
             logger.info("管理员密码哈希已更新")
             return True
 
@@ -146,7 +216,7 @@ class AuthService:
                 logger.warning("使用默认密码，建议修改！")
 
             # 哈希密码
-            password_hash = self.hash_password(admin_password)
+            password_hash = await self.hash_password(admin_password)
 
             # 存储到数据库
             success = await self.set_admin_password_hash(password_hash, db_session)
@@ -194,8 +264,13 @@ class AuthService:
                     }
 
             # 验证密码
-            if self.verify_password(password, password_hash):
+            if await self.verify_password(password, password_hash):
                 logger.info("管理员登录成功")
+                # 旧格式哈希在登录成功后升级为预哈希格式
+                if self.needs_rehash(password_hash):
+                    new_hash = await self.hash_password(password)
+                    if await self.set_admin_password_hash(new_hash, db_session):
+                        logger.info("管理员密码哈希已升级")
                 return {
                     "success": True,
                     "message": "登录成功",
@@ -235,37 +310,40 @@ class AuthService:
             结果字典，包含 success, message, error
         """
         try:
-            # 验证旧密码
-            verify_result = await self.verify_admin_login(old_password, db_session)
+            # 只查询一次密码记录，验证旧密码后直接在同一行上更新
+            stmt = select(Setting).where(Setting.key == "admin_password_hash").with_for_update()
+            result = await db_session.execute(stmt)
+            setting = result.scalar_one_or_none()
 
-            if not verify_result["success"]:
+            if not setting or not setting.value:
                 return {
                     "success": False,
                     "message": None,
-                    "error": "旧密码错误"
+                    "error": "系统错误：无法获取管理员密码"
                 }
 
-            # 哈希新密码
-            new_password_hash = self.hash_password(new_password)
-
-            # 更新密码
-            success = await self.set_admin_password_hash(new_password_hash, db_session)
-
-            if success:
-                logger.info("管理员密码修改成功")
-                return {
-                    "success": True,
-                    "message": "密码修改成功",
-                    "error": None
-                }
-            else:
+            if not await self.verify_password(old_password, setting.value):
+                logger.warning("修改管理员密码失败：旧密码错误")
                 return {
                     "success": False,
                     "message": None,
-                    "error": "密码修改失败"
+                    "error": "旧密码错误"
                 }
 
+            # 哈希新密码并更新
+            setting.value = await self.hash_password(new_password)
+            await db_session.commit()
+            self._pw_cache = None
+
+            logger.info("管理员密码修改成功")
+            return {
+                "success": True,
+                "message": "密码修改成功",
+                "error": None
+            }
+
         except Exception as e:
+            await db_session.rollback()
             logger.error(f"修改管理员密码失败: {e}")
             return {
                 "success": False,
@@ -2,18 +2,19 @@
 兑换流程服务
 协调用户兑换流程，包括验证、Team选择、邀请发送、事务处理和并发控制
 """
+import asyncio
 import logging
 from typing import Optional, Dict, Any
 from datetime import datetime, timedelta
-from sqlalchemy import select, and_
+from sqlalchemy import select, update, case, exists, and_, or_
 from sqlalchemy.ext.asyncio import AsyncSession
 
+from app.database import is_database_locked, lock_retry_delay, retry_on_database_locked
 from app.models import Team, RedemptionCode, RedemptionRecord
-from app.services.redemption import RedemptionService
-from app.services.warranty import WarrantyService
-from app.services.team import TeamService
-from app.services.chatgpt import ChatGPTService
-from app.services.encryption import encryption_service
+from app.services.redemption import redemption_service
+from app.services.warranty import warranty_service
+from app.services.team import team_service
+from app.services.chatgpt import chatgpt_service
 from app.utils.time_utils import get_now
 
 logger = logging.getLogger(__name__)
@@ -22,12 +23,15 @@ logger = logging.getLogger(__name__)
 class RedeemFlowService:
     """兑换流程服务类"""
 
+    # 发送邀请的总超时 (秒)，需覆盖 ChatGPTService 内部的重试和退避
+    INVITE_TIMEOUT = 120
+
     def __init__(self):
         """初始化兑换流程服务"""
-        from app.services.chatgpt import chatgpt_service
-        self.redemption_service = RedemptionService()
-        self.warranty_service = WarrantyService()
-        self.team_service = TeamService()
+        # 复用各模块的全局实例，与其共享缓存和状态
+        self.redemption_service = redemption_service
+        self.warranty_service = warranty_service
+        self.team_service = team_service
         self.chatgpt_service = chatgpt_service
 
     async def verify_code_and_get_teams(
@@ -104,7 +108,8 @@ class RedeemFlowService:
     async def select_team_auto(
         self,
         db_session: AsyncSession,
-        email: Optional[str] = None
+        email: Optional[str] = None,
+        lock: bool = False
     ) -> Dict[str, Any]:
         """
         自动选择 Team (选择过期时间最早的)
@@ -113,6 +118,8 @@ class RedeemFlowService:
         Args:
             db_session: 数据库会话
             email: 用户邮箱 (用于排除已加入的 Team)
+            lock: 是否对选中的 Team 加行锁 (FOR UPDATE SKIP LOCKED，已被锁定的 Team 直接跳过；
+                SQLite 不支持行锁，由写事务本身保证串行)
 
         Returns:
             结果字典,包含 success, team_id, error
@@ -138,6 +145,8 @@ class RedeemFlowService:
                 stmt = stmt.where(Team.id.not_in(exclude_team_ids))
             
             stmt = stmt.order_by(Team.expires_at.asc()).limit(1)
+            if lock:
+                stmt = stmt.with_for_update(skip_locked=True)
 
             result = await db_session.execute(stmt)
             team = result.scalar_one_or_none()
@@ -194,117 +203,185 @@ class RedeemFlowService:
             
             logger.info(f"正在尝试兑换 (第 {attempt + 1}/{max_retries} 次尝试): email={email}, code={code}")
             team_id_final = None
+            # 阶段 1 提交后置为 True，直到占位被确认 (阶段 3) 或已回退；
+            # 为 True 时 finally 中回退占位，保证请求被取消时也不会残留占位
+            needs_rollback = False
             try:
-                # --- 阶段 1: 验证并占位 (短事务) ---
-                async with db_session.begin():
-                    # 1. 验证兑换码 (在事务内验证确保原子性)
-                    validate_result = await self.redemption_service.validate_code(code, db_session)
+                # --- 阶段 0: 预检 (只读，放在写事务之外以缩短持锁时间) ---
+                # 1. 验证兑换码
+                validate_result = await self.redemption_service.validate_code(code, db_session)
+                if not validate_result["success"] or not validate_result["valid"]:
+                    # validate_code 可能将超期未用的码标记为 expired，提交以持久化
+                    await db_session.commit()
                     if not validate_result["success"]:
                         return {"success": False, "error": validate_result["error"]}
-                    if not validate_result["valid"]:
-                        return {"success": False, "error": validate_result["reason"]}
-
-                    # 再次验证并锁定 (带锁锁定，防止并发)
-                    stmt = select(RedemptionCode).where(RedemptionCode.code == code).with_for_update()
-                    result = await db_session.execute(stmt)
-                    redemption_code = result.scalar_one_or_none()
-                    
-                    if not redemption_code:
-                        return {"success": False, "error": "兑换码记录丢失"}
-
-                    # 检查状态是否依然有效 (可能在循环间隙被别人捷足先登)
-                    allowed_statuses = ["unused", "warranty_active"]
-                    if redemption_code.has_warranty:
-                        allowed_statuses.append("used")
+                    return {"success": False, "error": validate_result["reason"]}
+
+                redemption_code = validate_result["redemption_code"]
+                is_warranty_code = redemption_code["has_warranty"]
+                observed_status = redemption_code["status"]
+                observed_used_at = redemption_code["used_at"]
+                is_first_use = observed_status == "unused"
+
+                # 特殊处理质保码逻辑
+                if not is_first_use:
+                    # 如果不是首次使用，检查是否为质保码且可重复使用
+                    if not is_warranty_code:
+                        await db_session.rollback()
+                        return {"success": False, "error": "兑换码已被占用"}
+                    warranty_check = await self.warranty_service.validate_warranty_reuse(
+                        db_session, code, email
+                    )
+                    if not warranty_check["success"] or not warranty_check["can_reuse"]:
+                        await db_session.rollback()
+                        return {"success": False, "error": warranty_check.get("reason", "兑换码质保验证未通过")}
 
-                    if redemption_code.status not in allowed_statuses:
-                        return {"success": False, "error": "兑换码已被使用"}
+                # 结束预检查询隐式开启的读事务，否则下方 begin() 会报错
+                await db_session.rollback()
 
+                # --- 阶段 1: 占位 (短事务) ---
+                # 占位通过带条件的 UPDATE 完成，由数据库原子地检查并修改，不在应用逻辑期间持有行锁
+                async with db_session.begin():
                     # 2. 选择 Team
                     if current_target_team_id is None:
-                        select_result = await self.select_team_auto(db_session, email=email)
+                        # 自动选择时跳过被其他兑换锁定的 Team
+                        select_result = await self.select_team_auto(db_session, email=email, lock=True)
                         if not select_result["success"]:
                             return {"success": False, "error": select_result["error"]}
-                        team_id_final = select_result["team_id"]
+                        target_team_id = select_result["team_id"]
                     else:
-                        team_id_final = current_target_team_id
-
-                    # 3. 锁定并检查 Team
-                    stmt = select(Team).where(Team.id == team_id_final).with_for_update()
+                        target_team_id = current_target_team_id
+
+                    # 3. 原子地检查 Team 容量和状态并增加成员数占位
+                    stmt = (
+                        update(Team)
+                        .where(
+                            Team.id == target_team_id,
+                            Team.status == "active",
+                            Team.current_members < Team.max_members
+                        )
+                        .values(
+                            current_members=Team.current_members + 1,
+                            status=case(
+                                (Team.current_members + 1 >= Team.max_members, "full"),
+                                else_=Team.status
+                            )
+                        )
+                        .returning(Team.account_id, Team.team_name, Team.expires_at, Team.access_token_encrypted)
+                    )
                     result = await db_session.execute(stmt)
-                    team = result.scalar_one_or_none()
+                    reserved = result.first()
+
+                    if reserved is None:
+                        # 条件不满足，查询具体原因 (只读取相关列，避免加载 Token 等大字段)
+                        stmt = select(
+                            Team.current_members,
+                            Team.max_members,
+                            Team.status
+                        ).where(Team.id == target_team_id)
+                        result = await db_session.execute(stmt)
+                        team = result.first()
+
+                        if not team:
+                            if current_target_team_id is None and attempt < max_retries - 1:
+                                logger.warning(f"选择的 Team {target_team_id} 消失了, 尝试下一次循环")
+                                continue
+                            return {"success": False, "error": f"Team {target_team_id} 不存在"}
+
+                        if team.current_members >= team.max_members:
+                            if current_target_team_id is None and attempt < max_retries - 1:
+                                logger.warning(f"选择的 Team {target_team_id} 已满, 尝试下一次循环")
+                                continue
+                            return {"success": False, "error": "Team 已满，请选择其他 Team"}
 
-                    if not team:
-                        if current_target_team_id is None and attempt < max_retries - 1:
-                            logger.warning(f"选择的 Team {team_id_final} 消失了, 尝试下一次循环")
-                            continue
-                        return {"success": False, "error": f"Team {team_id_final} 不存在"}
-                    
-                    if team.current_members >= team.max_members:
-                        if current_target_team_id is None and attempt < max_retries - 1:
-                            logger.warning(f"选择的 Team {team_id_final} 已满, 尝试下一次循环")
-                            continue 
-                        return {"success": False, "error": "Team 已满，请选择其他 Team"}
-                    
-                    if team.status != "active":
                         if current_target_team_id is None and attempt < max_retries - 1:
-                            logger.warning(f"选择的 Team {team_id_final} 状态异常 ({team.status}), 尝试下一次循环")
+                            logger.warning(f"选择的 Team {target_team_id} 状态异常 ({team.status}), 尝试下一次循环")
                             continue
                         return {"success": False, "error": f"Team 状态异常: {team.status}"}
 
-                    # 特殊处理质保码逻辑
-                    is_warranty_code = redemption_code.has_warranty
-                    is_first_use = redemption_code.status == "unused"
-                    
+                    # 4. 更新兑换码状态，仅当状态仍为预检时读取的值才生效 (并发请求中只有一个能成功)
+                    now = get_now()
+                    code_values = {
+                        "status": "warranty_active" if is_warranty_code else "used",
+                        "used_by_email": email,
+                        "used_team_id": target_team_id,
+                        "used_at": now
+                    }
+                    if is_warranty_code and is_first_use:
+                        warranty_days = redemption_code["warranty_days"] or 30
+                        code_values["warranty_expires_at"] = now + timedelta(days=warranty_days)
+
+                    # 质保码重复使用时状态不变 (warranty_active -> warranty_active)，仅比较状态无法区分并发请求，
+                    # 因此同时比较使用时间 (每次占位都会更新)，并要求上一次占位已完成:
+                    # 成功兑换的记录时间不早于占位时间，回退时使用时间恢复为最后一次成功兑换的时间
+                    conditions = [
+                        RedemptionCode.code == code,
+                        RedemptionCode.status == observed_status
+                    ]
                     if not is_first_use:
-                        # 如果不是首次使用，检查是否为质保码且可重复使用
-                        if is_warranty_code:
-                            warranty_check = await self.warranty_service.validate_warranty_reuse(
-                                db_session, code, email
+                        conditions.append(
+                            RedemptionCode.used_at.is_(None) if observed_used_at is None
+                            else RedemptionCode.used_at == datetime.fromisoformat(observed_used_at)
+                        )
+                        conditions.append(
+                            or_(
+                                RedemptionCode.used_at.is_(None),
+                                exists().where(
+                                    RedemptionRecord.code == code,
+                                    RedemptionRecord.redeemed_at >= RedemptionCode.used_at
+                                )
                             )
-                            if not warranty_check["success"] or not warranty_check["can_reuse"]:
-                                return {"success": False, "error": warranty_check.get("reason", "兑换码质保验证未通过")}
-                        else:
-                            return {"success": False, "error": "兑换码已被占用"}
-
-                    # 4. 更新状态执行占位
-                    if is_warranty_code:
-                        redemption_code.status = "warranty_active"
-                        if is_first_use:
-                            warranty_days = redemption_code.warranty_days or 30
-                            redemption_code.warranty_expires_at = get_now() + timedelta(days=warranty_days)
-                    else:
-                        redemption_code.status = "used"
-                    
-                    redemption_code.used_by_email = email
-                    redemption_code.used_team_id = team_id_final
-                    redemption_code.used_at = get_now()
-
-                    # 增加 Team 成员数占位
-                    team.current_members += 1
-                    if team.current_members >= team.max_members:
-                        team.status = "full"
-                    
+                        )
+
+                    stmt = (
+                        update(RedemptionCode)
+                        .where(*conditions)
+                        .values(**code_values)
+                        .returning(RedemptionCode.id)
+                    )
+                    result = await db_session.execute(stmt)
+                    if result.first() is None:
+                        # 兑换码已被并发请求占用，撤销本事务中的 Team 占位
+                        await db_session.rollback()
+                        return {"success": False, "error": "兑换码已被使用"}
+
                     # 记录信息供 Phase 2 使用
-                    final_team_account_id = team.account_id
-                    final_team_name = team.team_name
-                    final_team_expires_at = team.expires_at
-                    final_access_token_encrypted = team.access_token_encrypted
+                    team_id_final = target_team_id
+                    final_team_account_id = reserved.account_id
+                    final_team_name = reserved.team_name
+                    final_team_expires_at = reserved.expires_at
+                    final_access_token_encrypted = reserved.access_token_encrypted
                     final_is_warranty = is_warranty_code
                     
                     # 事务 commit
+                needs_rollback = True
+                if is_warranty_code and is_first_use:
+                    # 首次使用写入了质保到期时间
+                    self.redemption_service.invalidate_code_meta(code)
                 
                 # --- 阶段 2: 网络请求 ---
                 try:
-                    access_token = encryption_service.decrypt_token(final_access_token_encrypted)
+                    access_token = self.team_service.get_redeem_access_token(
+                        team_id_final, final_access_token_encrypted
+                    )
                 except Exception as e:
                     logger.error(f"解密 Token 失败: {e}")
+                    needs_rollback = False
                     await self._rollback_redemption(db_session, code, team_id_final)
                     return {"success": False, "error": f"系统解密失败: {str(e)}"}
 
-                invite_result = await self.chatgpt_service.send_invite(
-                    access_token, final_team_account_id, email, db_session
-                )
+                try:
+                    invite_result = await asyncio.wait_for(
+                        self.chatgpt_service.send_invite(
+                            access_token, final_team_account_id, email, db_session
+                        ),
+                        timeout=self.INVITE_TIMEOUT
+                    )
+                except asyncio.TimeoutError:
+                    invite_result = {
+                        "success": False,
+                        "error": f"邀请请求超时 ({self.INVITE_TIMEOUT} 秒)"
+                    }
 
                 # --- 阶段 3: 最终化 ---
                 if invite_result["success"]:
@@ -321,6 +398,7 @@ class RedeemFlowService:
                             is_warranty_redemption=final_is_warranty
                         )
                         db_session.add(redemption_record)
+                    needs_rollback = False
                     
                     logger.info(f"兑换成功: {email} 加入 Team {team_id_final}")
                     return {
@@ -336,6 +414,7 @@ class RedeemFlowService:
                     }
                 else:
                     logger.warning(f"API 邀请失败 (尝试 {attempt + 1}): {invite_result['error']}")
+                    needs_rollback = False
                     await self._rollback_redemption(db_session, code, team_id_final)
                     
                     error_msg = invite_result.get("error", "未知错误")
@@ -363,14 +442,20 @@ class RedeemFlowService:
 
             except Exception as e:
                 logger.error(f"兑换尝试异常 (第 {attempt + 1} 次): {e}")
-                if team_id_final:
-                    try:
-                        await self._rollback_redemption(db_session, code, team_id_final)
-                    except:
-                        pass
+                if needs_rollback:
+                    needs_rollback = False
+                    await self._rollback_redemption(db_session, code, team_id_final)
                 if attempt < max_retries - 1:
+                    if is_database_locked(e):
+                        # 数据库被锁定时退避后再重试，避免与持锁事务反复冲突
+                        await asyncio.sleep(lock_retry_delay(attempt))
                     continue
                 return {"success": False, "error": f"兑换系统异常: {str(e)}"}
+            finally:
+                # 仅在请求被取消等未被上方捕获的情况下仍为 True；
+                # shield 使回退不会被同一次取消打断
+                if needs_rollback:
+                    await asyncio.shield(self._rollback_redemption(db_session, code, team_id_final))
 
     async def _rollback_redemption(
         self,
@@ -380,58 +465,78 @@ class RedeemFlowService:
     ):
         """回退兑换占位"""
         try:
-            # 确保会话干净，防止在异常处理路径中再次触发事务冲突
-            if db_session.in_transaction():
-                await db_session.rollback()
-                
-            async with db_session.begin():
-                # 回退兑换码状态
-                stmt = select(RedemptionCode).where(RedemptionCode.code == code).with_for_update()
-                result = await db_session.execute(stmt)
-                redemption_code = result.scalar_one_or_none()
-                if redemption_code:
-                    # 质保码回退到 warranty_active 或 unused
-                    if redemption_code.has_warranty:
-                        # 检查是否有其他成功的兑换记录
-                        stmt = select(RedemptionRecord).where(
-                            RedemptionRecord.code == code
-                        ).order_by(RedemptionRecord.redeemed_at.desc())
-                        result = await db_session.execute(stmt)
-                        other_record = result.scalars().first()
-                        
-                        if other_record:
-                            # 有其他记录，恢复为最后一次成功的状态
-                            redemption_code.status = "warranty_active"
-                            redemption_code.used_by_email = other_record.email
-                            redemption_code.used_team_id = other_record.team_id
-                            redemption_code.used_at = other_record.redeemed_at
-                        else:
-                            # 没有其他成功记录，彻底回退到未使用
-                            redemption_code.status = "unused"
-                            redemption_code.warranty_expires_at = None
-                            redemption_code.used_by_email = None
-                            redemption_code.used_team_id = None
-                            redemption_code.used_at = None
-                    else:
-                        # 普通码彻底回退到 unused
-                        redemption_code.status = "unused"
-                        redemption_code.used_by_email = None
-                        redemption_code.used_team_id = None
-                        redemption_code.used_at = None
-
-                # 回退 Team 计数
-                stmt = select(Team).where(Team.id == team_id).with_for_update()
-                result = await db_session.execute(stmt)
-                team = result.scalar_one_or_none()
-                if team:
-                    if team.current_members > 0:
-                        team.current_members -= 1
-                    if team.status == "full" and team.current_members < team.max_members:
-                        team.status = "active"
+            await self._release_reservation(db_session, code, team_id)
             logger.info(f"已回退兑换占位: code={code}, team_id={team_id}")
         except Exception as e:
             logger.error(f"回退兑换占位失败: {e}")
 
+    @retry_on_database_locked
+    async def _release_reservation(
+        self,
+        db_session: AsyncSession,
+        code: str,
+        team_id: int
+    ):
+        """在新事务中释放兑换码和 Team 占位，数据库被锁定时自动重试"""
+        # 确保会话干净，防止在异常处理路径中再次触发事务冲突
+        if db_session.in_transaction():
+            await db_session.rollback()
+
+        async with db_session.begin():
+            # 回退兑换码状态: 单条条件 UPDATE，无需先 SELECT 再修改
+            # 质保码若有其他成功兑换记录，恢复为最后一次成功的状态，否则彻底回退到 unused；
+            # 普通码彻底回退到 unused
+            def latest_record(column):
+                return (
+                    select(column)
+                    .where(RedemptionRecord.code == code)
+                    .order_by(RedemptionRecord.redeemed_at.desc())
+                    .limit(1)
+                    .scalar_subquery()
+                )
+
+            restore_record = and_(
+                RedemptionCode.has_warranty.is_(True),
+                exists().where(RedemptionRecord.code == code)
+            )
+            await db_session.execute(
+                update(RedemptionCode)
+                .where(
+                    RedemptionCode.code == code,
+                    RedemptionCode.status.in_(["used", "warranty_active"])
+                )
+                .values(
+                    status=case((restore_record, "warranty_active"), else_="unused"),
+                    used_by_email=case((restore_record, latest_record(RedemptionRecord.email)), else_=None),
+                    used_team_id=case((restore_record, latest_record(RedemptionRecord.team_id)), else_=None),
+                    used_at=case((restore_record, latest_record(RedemptionRecord.redeemed_at)), else_=None),
+                    warranty_expires_at=case(
+                        (and_(RedemptionCode.has_warranty.is_(True), ~restore_record), None),
+                        else_=RedemptionCode.warranty_expires_at
+                    )
+                )
+            )
+
+            # 回退 Team 计数 (SET 中引用的均为更新前的值)
+            new_members = case(
+                (Team.current_members > 0, Team.current_members - 1),
+                else_=Team.current_members
+            )
+            await db_session.execute(
+                update(Team)
+                .where(Team.id == team_id)
+                .values(
+                    current_members=new_members,
+                    status=case(
+                        (and_(Team.status == "full", new_members < Team.max_members), "active"),
+                        else_=Team.status
+                    )
+                )
+            )
+
+        # 兑换码的质保到期时间可能已被回退
+        self.redemption_service.invalidate_code_meta(code)
+
 
 # 创建全局实例
 redeem_flow_service = RedeemFlowService()
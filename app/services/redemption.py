@@ -5,7 +5,7 @@
 import logging
 import secrets
 import string
-from typing import Optional, Dict, Any, List
+from typing import Optional, Dict, Any, List, Tuple
 from datetime import datetime, timedelta
 from sqlalchemy import select, update, delete, and_, or_, func
 from sqlalchemy.ext.asyncio import AsyncSession
@@ -13,16 +13,22 @@ from sqlalchemy.orm import selectinload
 
 from app.models import RedemptionCode, RedemptionRecord, Team
 from app.utils.time_utils import get_now
+from app.utils.ttl_cache import TTLCache
 
 logger = logging.getLogger(__name__)
 
+# 兑换码质保元数据缓存有效期 (秒)
+CODE_META_CACHE_TTL = 60
+
 
 class RedemptionService:
     """兑换码管理服务类"""
 
     def __init__(self):
         """初始化兑换码管理服务"""
-        pass
+        # 兑换码质保元数据缓存: {code: (has_warranty, warranty_expires_at)}
+        # 修改这两个字段的操作需调用 invalidate_code_meta
+        self._code_meta_cache = TTLCache(maxsize=10_000, ttl=CODE_META_CACHE_TTL)
 
     def _generate_random_code(self, length: int = 16) -> str:
         """
@@ -291,7 +297,11 @@ class RedemptionService:
                         "error": None
                     }
 
-            # 4. 验证通过
+            # 4. 验证通过，顺便缓存质保元数据供后续质保校验使用
+            self._code_meta_cache.set(
+                redemption_code.code,
+                (redemption_code.has_warranty, redemption_code.warranty_expires_at)
+            )
             return {
                 "success": True,
                 "valid": True,
@@ -300,7 +310,10 @@ class RedemptionService:
                     "id": redemption_code.id,
                     "code": redemption_code.code,
                     "status": redemption_code.status,
+                    "has_warranty": redemption_code.has_warranty,
+                    "warranty_days": redemption_code.warranty_days,
                     "expires_at": redemption_code.expires_at.isoformat() if redemption_code.expires_at else None,
+                    "used_at": redemption_code.used_at.isoformat() if redemption_code.used_at else None,
                     "created_at": redemption_code.created_at.isoformat() if redemption_code.created_at else None
                 },
                 "error": None
@@ -316,6 +329,40 @@ class RedemptionService:
                 "error": f"验证兑换码失败: {str(e)}"
             }
 
+    async def get_code_meta(
+        self,
+        code: str,
+        db_session: AsyncSession
+    ) -> Optional[Tuple[bool, Optional[datetime]]]:
+        """
+        获取兑换码的质保元数据，优先读取缓存
+
+        Args:
+            code: 兑换码
+            db_session: 数据库会话
+
+        Returns:
+            (has_warranty, warranty_expires_at)，兑换码不存在时返回 None
+        """
+        meta = self._code_meta_cache.get(code)
+        if meta is None:
+            stmt = select(
+                RedemptionCode.has_warranty,
+                RedemptionCode.warranty_expires_at
+            ).where(RedemptionCode.code == code)
+            result = await db_session.execute(stmt)
+            row = result.first()
+            if row is None:
+                return None
+            meta = (row.has_warranty, row.warranty_expires_at)
+            self._code_meta_cache.set(code, meta)
+        return meta
+
+    def invalidate_code_meta(self, *codes: str) -> None:
+        """兑换码的 has_warranty / warranty_expires_at 被修改或删除后，清除其缓存"""
+        for code in codes:
+            self._code_meta_cache.pop(code)
+
     async def use_code(
         self,
         code: str,
@@ -704,6 +751,7 @@ class RedemptionService:
             # 删除兑换码
             await db_session.delete(redemption_code)
             await db_session.commit()
+            self.invalidate_code_meta(code)
 
             logger.info(f"删除兑换码成功: {code}")
 
@@ -793,6 +841,7 @@ class RedemptionService:
             # 4. 删除使用记录
             await db_session.delete(record)
             await db_session.commit()
+            self.invalidate_code_meta(record.code)
 
             logger.info(f"撤回记录成功: {record_id}, 邮箱: {record.email}, 兑换码: {record.code}")
 
@@ -844,6 +893,7 @@ class RedemptionService:
             stmt = update(RedemptionCode).where(RedemptionCode.code.in_(codes)).values(values)
             await db_session.execute(stmt)
             await db_session.commit()
+            self.invalidate_code_meta(*codes)
 
             logger.info(f"成功批量更新 {len(codes)} 个兑换码")
 
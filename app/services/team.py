@@ -16,9 +16,13 @@ from app.services.encryption import encryption_service
 from app.utils.token_parser import TokenParser
 from app.utils.jwt_parser import JWTParser
 from app.utils.time_utils import get_now
+from app.utils.ttl_cache import TTLCache
 
 logger = logging.getLogger(__name__)
 
+# 兑换流程中 AT Token 解密结果的缓存有效期 (秒)
+ACCESS_TOKEN_CACHE_TTL = 300
+
 
 class TeamService:
     """Team 管理服务类"""
@@ -29,6 +33,9 @@ class TeamService:
         self.chatgpt_service = chatgpt_service
         self.token_parser = TokenParser()
         self.jwt_parser = JWTParser()
+        # 兑换流程使用的 AT Token 明文缓存: {team_id: (密文, 明文)}
+        # 仅供 get_redeem_access_token 使用，修改 AT Token 或删除 Team 时需调用 invalidate_access_token
+        self._access_token_cache = TTLCache(maxsize=1024, ttl=ACCESS_TOKEN_CACHE_TTL)
 
     async def _handle_api_error(self, result: Dict[str, Any], team: Team, db_session: AsyncSession) -> bool:
         """
@@ -103,6 +110,30 @@ class TeamService:
             team.status = "active"
         await db_session.commit()
 
+    def get_redeem_access_token(self, team_id: int, access_token_encrypted: str) -> str:
+        """
+        解密兑换流程中 Team 的 AT Token，短时间内重复兑换同一 Team 时复用解密结果
+
+        Args:
+            team_id: Team ID
+            access_token_encrypted: 数据库中当前的 AT Token 密文
+
+        Returns:
+            AT Token 明文
+        """
+        cached = self._access_token_cache.get(team_id)
+        # 密文不一致说明 Token 已被更新，重新解密
+        if cached is not None and cached[0] == access_token_encrypted:
+            return cached[1]
+        access_token = encryption_service.decrypt_token(access_token_encrypted)
+        self._access_token_cache.set(team_id, (access_token_encrypted, access_token))
+        return access_token
+
+    def invalidate_access_token(self, *team_ids: int) -> None:
+        """Team 的 AT Token 被修改或 Team 被删除后，清除其缓存"""
+        for team_id in team_ids:
+            self._access_token_cache.pop(team_id)
+
     async def ensure_access_token(self, team: Team, db_session: AsyncSession) -> Optional[str]:
         """
         确保 AT Token 有效,如果过期则尝试刷新
@@ -137,6 +168,7 @@ class TeamService:
                 new_at = refresh_result["access_token"]
                 logger.info(f"Team {team.id} 通过 session_token 成功刷新 AT")
                 team.access_token_encrypted = encryption_service.encrypt_token(new_at)
+                self.invalidate_access_token(team.id)
                 # 成功刷新，重置错误状态
                 await self._reset_error_status(team, db_session)
                 return new_at
@@ -156,6 +188,7 @@ class TeamService:
                 new_rt = refresh_result.get("refresh_token")
                 logger.info(f"Team {team.id} 通过 refresh_token 成功刷新 AT")
                 team.access_token_encrypted = encryption_service.encrypt_token(new_at)
+                self.invalidate_access_token(team.id)
                 if new_rt:
                     team.refresh_token_encrypted = encryption_service.encrypt_token(new_rt)
                 # 成功刷新，重置错误状态
@@ -524,6 +557,7 @@ class TeamService:
             # 3. 更新 Token
             if access_token:
                 team.access_token_encrypted = encryption_service.encrypt_token(access_token)
+                self.invalidate_access_token(team.id)
             if refresh_token:
                 team.refresh_token_encrypted = encryption_service.encrypt_token(refresh_token)
             if session_token:
@@ -1832,6 +1866,7 @@ class TeamService:
             # 2. 删除 Team (级联删除 team_accounts 和 redemption_records)
             await db_session.delete(team)
             await db_session.commit()
+            self.invalidate_access_token(team_id)
 
             logger.info(f"删除 Team {team_id} 成功")
 
@@ -2,29 +2,50 @@
 质保服务
 处理用户质保查询和验证
 """
+import asyncio
 import logging
-from typing import Optional, Dict, Any, List
-from datetime import datetime, timedelta
-from sqlalchemy import select, and_, or_
-from sqlalchemy.ext.asyncio import AsyncSession
+import time
+from typing import Optional, Dict, Any, List, Iterable, Set
+from datetime import timedelta
+from sqlalchemy import select, func, and_, or_, case
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker
 
+from app.database import AsyncSessionLocal
 from app.models import RedemptionCode, RedemptionRecord, Team
+from app.services.redemption import redemption_service
+from app.services.team import team_service
 from app.utils.time_utils import get_now
+from app.utils.ttl_cache import TTLCache
 
 logger = logging.getLogger(__name__)
 
-# 全局频率限制字典: {(type, key): last_time}
-# type: 'email' or 'code'
-_query_rate_limit = {}
+# 质保查询频率限制间隔 (秒)
+QUERY_RATE_LIMIT_SECONDS = 30
+
+# Team 状态在该时间 (秒) 内同步过则视为新鲜，质保查询不再触发同步
+TEAM_SYNC_FRESH_SECONDS = 60
+
+# 全局频率限制缓存: {(type, key): last_time (time.monotonic())}
+# type: 'email' or 'code'；条目过期后自动淘汰，容量有上限
+_query_rate_limit = TTLCache(maxsize=100_000, ttl=QUERY_RATE_LIMIT_SECONDS)
 
 
 class WarrantyService:
     """质保服务类"""
 
-    def __init__(self):
-        """初始化质保服务"""
-        from app.services.team import TeamService
-        self.team_service = TeamService()
+    def __init__(self, session_factory: async_sessionmaker[AsyncSession] = AsyncSessionLocal):
+        """
+        初始化质保服务
+
+        Args:
+            session_factory: 后台同步任务使用的会话工厂，每个任务各自创建独立会话
+        """
+        self.team_service = team_service
+        self._session_factory = session_factory
+        # 正在后台同步的 Team ID 及任务
+        self._sync_in_flight: Set[int] = set()
+        self._sync_tasks: Set[asyncio.Task] = set()
+        self._sync_lock = asyncio.Lock()
 
     async def check_warranty_status(
         self,
@@ -52,35 +73,32 @@ class WarrantyService:
                 }
 
             # 0. 频率限制 (每个邮箱或每个码 30 秒只能查一次)
-            now = datetime.now()
+            now = time.monotonic()
             limit_key = ("email", email) if email else ("code", code)
             last_time = _query_rate_limit.get(limit_key)
-            if last_time and (now - last_time).total_seconds() < 30:
-                wait_time = int(30 - (now - last_time).total_seconds())
+            if last_time is not None and now - last_time < QUERY_RATE_LIMIT_SECONDS:
+                wait_time = int(QUERY_RATE_LIMIT_SECONDS - (now - last_time))
                 return {
                     "success": False,
                     "error": f"查询太频繁,请 {wait_time} 秒后再试"
                 }
-            _query_rate_limit[limit_key] = now
+            _query_rate_limit.set(limit_key, now)
 
             # 1. 查找兑换记录和相关联的 Team, Code
             records_data = []
 
             if code:
-                # 通过兑换码查找所有关联记录
+                # 通过兑换码查找最近一条关联记录 (LIMIT 1，只取最新一行)
                 stmt = (
                     select(RedemptionRecord, RedemptionCode, Team)
                     .join(RedemptionCode, RedemptionRecord.code == RedemptionCode.code)
                     .join(Team, RedemptionRecord.team_id == Team.id)
                     .where(RedemptionCode.code == code)
                     .order_by(RedemptionRecord.redeemed_at.desc())
+                    .limit(1)
                 )
                 result = await db_session.execute(stmt)
-                first_record = result.first()
-                if first_record:
-                    records_data = [first_record]
-                else:
-                    records_data = []
+                records_data = result.all()
 
                 # 如果没有记录，可能是码还没被使用或不存在
                 if not records_data:
@@ -126,26 +144,29 @@ class WarrantyService:
                     }
 
             elif email:
-                # 通过邮箱查找所有兑换记录
+                # 通过邮箱查找兑换记录，在数据库中按兑换码分组只保留最近一条
+                latest = (
+                    select(
+                        RedemptionRecord.id,
+                        func.row_number().over(
+                            partition_by=RedemptionRecord.code,
+                            order_by=RedemptionRecord.redeemed_at.desc()
+                        ).label("rn")
+                    )
+                    .join(RedemptionCode, RedemptionRecord.code == RedemptionCode.code)
+                    .join(Team, RedemptionRecord.team_id == Team.id)
+                    .where(RedemptionRecord.email == email)
+                    .subquery()
+                )
                 stmt = (
                     select(RedemptionRecord, RedemptionCode, Team)
+                    .join(latest, and_(latest.c.id == RedemptionRecord.id, latest.c.rn == 1))
                     .join(RedemptionCode, RedemptionRecord.code == RedemptionCode.code)
                     .join(Team, RedemptionRecord.team_id == Team.id)
-                    .where(RedemptionRecord.email == email)
                     .order_by(RedemptionRecord.redeemed_at.desc())
                 )
                 result = await db_session.execute(stmt)
-                all_records = result.all()
-
-                # 只保留每个兑换码的最近一条记录
-                seen_codes = set()
-                records_data = []
-                for row in all_records:
-                    # row format: (RedemptionRecord, RedemptionCode, Team)
-                    record_obj = row[0]
-                    if record_obj.code not in seen_codes:
-                        seen_codes.add(record_obj.code)
-                        records_data.append(row)
+                records_data = result.all()
 
             if not records_data:
                 return {
@@ -160,7 +181,7 @@ class WarrantyService:
                     "message": "未找到兑换记录"
                 }
 
-            # 2. 处理记录并进行必要的实时同步
+            # 2. 处理记录
             final_records = []
             banned_teams_info = []
             has_any_warranty = False
@@ -169,13 +190,13 @@ class WarrantyService:
             primary_code = None
             can_reuse = False
 
-            for record, code_obj, team in records_data:
-                # 同步 Team 状态
-                if team.status not in ["banned", "error"]:
-                    logger.info(f"质保查询: 正在实时测试 Team {team.id} ({team.team_name}) 的状态")
-                    await self.team_service.sync_team_info(team.id, db_session)
-                    # 同步后 team 对象的属性会自动更新
+            # 后台刷新 Team 状态，本次查询直接使用数据库中最近一次同步的结果
+            await self._schedule_team_sync(
+                team for _, _, team in records_data
+                if team.status not in ["banned", "error"]
+            )
 
+            for record, code_obj, team in records_data:
                 # 动态计算/提取质保信息
                 expiry_date = code_obj.warranty_expires_at
                 
@@ -252,6 +273,48 @@ class WarrantyService:
                 "error": f"检查质保状态失败: {str(e)}"
             }
 
+    async def _schedule_team_sync(self, teams: Iterable[Team]) -> None:
+        """
+        为状态可能已过时的 Team 安排后台同步
+        最近 TEAM_SYNC_FRESH_SECONDS 秒内同步过或正在同步中的 Team 会被跳过
+        """
+        now = get_now()
+        async with self._sync_lock:
+            for team in teams:
+                if team.id in self._sync_in_flight:
+                    continue
+                if team.last_sync and (now - team.last_sync).total_seconds() < TEAM_SYNC_FRESH_SECONDS:
+                    continue
+                self._sync_in_flight.add(team.id)
+                logger.info(f"质保查询: 后台同步 Team {team.id} ({team.team_name}) 的状态")
+                task = asyncio.create_task(self._background_sync_team(team.id))
+                # 保留任务引用，防止执行中被垃圾回收
+                self._sync_tasks.add(task)
+                task.add_done_callback(self._sync_tasks.discard)
+
+    async def _background_sync_team(self, team_id: int) -> None:
+        """在独立会话中同步单个 Team (AsyncSession 不能被并发任务共享)"""
+        try:
+            async with self._session_factory() as session:
+                await self.team_service.sync_team_info(team_id, session)
+        except Exception as e:
+            logger.error(f"后台同步 Team {team_id} 失败: {e}")
+        finally:
+            async with self._sync_lock:
+                self._sync_in_flight.discard(team_id)
+
+    async def shutdown(self) -> None:
+        """
+        取消仍在运行的后台同步任务并等待其结束
+        需在关闭数据库引擎之前调用，避免任务在引擎释放后继续使用会话
+        """
+        tasks = list(self._sync_tasks)
+        for task in tasks:
+            task.cancel()
+        if tasks:
+            await asyncio.gather(*tasks, return_exceptions=True)
+            logger.info(f"已取消 {len(tasks)} 个后台同步任务")
+
     async def validate_warranty_reuse(
         self,
         db_session: AsyncSession,
@@ -270,12 +333,10 @@ class WarrantyService:
             结果字典,包含 success, can_reuse, reason, error
         """
         try:
-            # 1. 查询兑换码
-            stmt = select(RedemptionCode).where(RedemptionCode.code == code)
-            result = await db_session.execute(stmt)
-            redemption_code = result.scalar_one_or_none()
+            # 1. 查询兑换码质保元数据 (优先读取缓存)
+            code_meta = await redemption_service.get_code_meta(code, db_session)
 
-            if not redemption_code:
+            if code_meta is None:
                 return {
                     "success": True,
                     "can_reuse": False,
@@ -284,7 +345,8 @@ class WarrantyService:
                 }
 
             # 2. 检查是否为质保码
-            if not redemption_code.has_warranty:
+            has_warranty, warranty_expires_at = code_meta
+            if not has_warranty:
                 return {
                     "success": True,
                     "can_reuse": False,
@@ -293,8 +355,8 @@ class WarrantyService:
                 }
 
             # 3. 检查质保期是否有效
-            if redemption_code.warranty_expires_at:
-                if redemption_code.warranty_expires_at < get_now():
+            if warranty_expires_at:
+                if warranty_expires_at < get_now():
                     return {
                         "success": True,
                         "can_reuse": False,
@@ -304,39 +366,53 @@ class WarrantyService:
 
             # 4. 检查该兑换码当前是否已有正在使用的活跃 Team (全局检查，不限邮箱)
             # 逻辑：如果该码名下有任何一个 Team 还是 active/full 状态且未过期，则不允许新的激活
-            stmt = select(RedemptionRecord).where(RedemptionRecord.code == code)
+            # 在数据库中过滤有效 Team，只取一行；优先返回当前邮箱的记录
+            stmt = (
+                select(RedemptionRecord.email, Team.id, Team.team_name)
+                .join(Team, RedemptionRecord.team_id == Team.id)
+                .where(
+                    RedemptionRecord.code == code,
+                    Team.status.in_(["active", "full"]),
+                    or_(Team.expires_at.is_(None), Team.expires_at >= get_now())
+                )
+                .order_by((RedemptionRecord.email == email).desc())
+                .limit(1)
+            )
             result = await db_session.execute(stmt)
-            all_records_for_code = result.scalars().all()
-            
-            for record in all_records_for_code:
-                stmt = select(Team).where(Team.id == record.team_id)
-                result = await db_session.execute(stmt)
-                team = result.scalar_one_or_none()
-                
-                if team:
-                    is_expired = team.expires_at and team.expires_at < get_now()
-                    if team.status in ["active", "full"] and not is_expired:
-                        # 如果是同一个邮箱，提示已在有效 Team 中
-                        if record.email == email:
-                            return {
-                                "success": True,
-                                "can_reuse": False,
-                                "reason": f"您已在有效 Team 中 ({team.team_name or team.id})，不可重复兑换",
-                                "error": None
-                            }
-                        else:
-                            # 如果是不同邮箱，提示已被占用
-                            return {
-                                "success": True,
-                                "can_reuse": False,
-                                "reason": "该兑换码当前已被其他账号绑定且正在使用中。如需更换，请确保原账号已下车或原 Team 已失效。",
-                                "error": None
-                            }
-
-            # 5. 查找当前用户使用该兑换码的记录 (用于后续逻辑判断)
-            records = [r for r in all_records_for_code if r.email == email]
-            
-            if not records:
+            active_record = result.first()
+
+            if active_record:
+                record_email, active_team_id, active_team_name = active_record
+                # 如果是同一个邮箱，提示已在有效 Team 中
+                if record_email == email:
+                    return {
+                        "success": True,
+                        "can_reuse": False,
+                        "reason": f"您已在有效 Team 中 ({active_team_name or active_team_id})，不可重复兑换",
+                        "error": None
+                    }
+                # 如果是不同邮箱，提示已被占用
+                return {
+                    "success": True,
+                    "can_reuse": False,
+                    "reason": "该兑换码当前已被其他账号绑定且正在使用中。如需更换，请确保原账号已下车或原 Team 已失效。",
+                    "error": None
+                }
+
+            # 5. 统计当前用户使用该兑换码的记录数，以及其中是否有被封的 Team
+            stmt = (
+                select(
+                    func.count(RedemptionRecord.id),
+                    func.max(case((Team.status == "banned", 1), else_=0))
+                )
+                .select_from(RedemptionRecord)
+                .outerjoin(Team, RedemptionRecord.team_id == Team.id)
+                .where(RedemptionRecord.code == code, RedemptionRecord.email == email)
+            )
+            result = await db_session.execute(stmt)
+            record_count, banned_flag = result.one()
+
+            if not record_count:
                 # 之前没有该邮箱的记录，但上面已经检查过没有其他活跃 Team 了，所以允许“新开”或“接手”
                 return {
                     "success": True,
@@ -345,33 +421,8 @@ class WarrantyService:
                     "error": None
                 }
 
-            # 5. 检查用户当前是否已在有效的 Team 中
-            # 逻辑：如果最近一次加入的 Team 仍然有效（active/full 且未过期），则不允许重复使用
-            for record in records:
-                stmt = select(Team).where(Team.id == record.team_id)
-                result = await db_session.execute(stmt)
-                team = result.scalar_one_or_none()
-                
-                if team:
-                    # 如果有任何一个关联 Team 还是 active/full 状态，且未过期
-                    is_expired = team.expires_at and team.expires_at < get_now()
-                    if team.status in ["active", "full"] and not is_expired:
-                        return {
-                            "success": True,
-                            "can_reuse": False,
-                            "reason": f"您已在有效 Team 中 ({team.team_name or team.id})，不可重复兑换",
-                            "error": None
-                        }
-
             # 6. 检查是否有过被封的记录
-            has_banned_team = False
-            for record in records:
-                stmt = select(Team).where(Team.id == record.team_id)
-                result = await db_session.execute(stmt)
-                team = result.scalar_one_or_none()
-                if team and team.status == "banned":
-                    has_banned_team = True
-                    break
+            has_banned_team = bool(banned_flag)
             if has_banned_team:
                 return {
                     "success": True,
@@ -3,7 +3,8 @@ Token 正则匹配工具
 用于从文本中提取 AT Token、邮箱、Account ID 等信息
 """
 import re
-from typing import List, Optional, Dict
+from itertools import islice
+from typing import Iterator, List, Optional, Dict, Tuple
 import logging
 
 logger = logging.getLogger(__name__)
@@ -12,12 +13,16 @@ logger = logging.getLogger(__name__)
 class TokenParser:
     """Token 正则匹配解析器"""
 
+    # 解析器没有实例状态
+    __slots__ = ()
+
     # JWT Token 正则 (以 eyJ 开头的 Base64 字符串)
     # 简化匹配逻辑，三段式 Base64，Header 以 eyJ 开头
     JWT_PATTERN = r'eyJ[A-Za-z0-9_-]+\.[A-Za-z0-9_-]+\.[A-Za-z0-9_-]+'
 
     # 邮箱正则 (更通用的邮箱格式)
-    EMAIL_PATTERN = r'[a-zA-Z0-9._%+-]+@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,}'
+    # 按 RFC 5321 限制各部分长度: 本地部分最多 64 位，域名每段最多 63 位，顶级域名最多 24 位
+    EMAIL_PATTERN = r'[a-zA-Z0-9._%+-]{1,64}@[a-zA-Z0-9-]{1,63}(?:\.[a-zA-Z0-9-]{1,63}){0,4}\.[a-zA-Z]{2,24}'
 
     # Account ID 正则 (UUID 格式)
     ACCOUNT_ID_PATTERN = r'[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}'
@@ -26,11 +31,61 @@ class TokenParser:
     REFRESH_TOKEN_PATTERN = r'rt-[A-Za-z0-9_-]+'
     
     # Session Token 正则 (通常比较长，包含两个点)
-    SESSION_TOKEN_PATTERN = r'eyJ[A-Za-z0-9_-]+\.[A-Za-z0-9_-]*\.[A-Za-z0-9_-]+(\.[A-Za-z0-9_-]+\.[A-Za-z0-9_-]+)?'
+    SESSION_TOKEN_PATTERN = r'eyJ[A-Za-z0-9_-]+\.[A-Za-z0-9_-]*\.[A-Za-z0-9_-]+(?:\.[A-Za-z0-9_-]+\.[A-Za-z0-9_-]+)?'
 
     # Client ID 正则 (根据用户提供的信息: app_ 开头)
     CLIENT_ID_PATTERN = r'app_[A-Za-z0-9]+'
 
+    # 预编译的正则对象，避免每次调用都经过 re 模块的缓存查找
+    # Token、Account ID 等只含 ASCII 字符，使用 re.ASCII 编译 (大小写不敏感匹配时无需 Unicode 大小写折叠)
+    _JWT_RE = re.compile(JWT_PATTERN, re.ASCII)
+    _EMAIL_RE = re.compile(EMAIL_PATTERN)
+    # 邮箱本地部分字符组成的一段，以及只在这样一段起始位置尝试的邮箱正则
+    _EMAIL_LOCAL_RUN_RE = re.compile(r'[a-zA-Z0-9._%+-]*')
+    _EMAIL_AT_RUN_START_RE = re.compile(r'(?<![a-zA-Z0-9._%+-])' + EMAIL_PATTERN)
+    _ACCOUNT_ID_RE = re.compile(ACCOUNT_ID_PATTERN, re.ASCII)
+    # 导入文本中的 Account ID 不区分大小写
+    _ACCOUNT_ID_ICASE_RE = re.compile(ACCOUNT_ID_PATTERN, re.IGNORECASE | re.ASCII)
+    _REFRESH_TOKEN_RE = re.compile(REFRESH_TOKEN_PATTERN, re.ASCII)
+    _SESSION_TOKEN_RE = re.compile(SESSION_TOKEN_PATTERN, re.ASCII)
+    _CLIENT_ID_RE = re.compile(CLIENT_ID_PATTERN, re.ASCII)
+
+    # 校验函数直接使用绑定好的 fullmatch 方法
+    _JWT_FULLMATCH = _JWT_RE.fullmatch
+    _EMAIL_FULLMATCH = _EMAIL_RE.fullmatch
+    _ACCOUNT_ID_FULLMATCH = _ACCOUNT_ID_RE.fullmatch
+
+    # 导入行片段分类: 按以下顺序取第一个匹配的类型，group 名即类型
+    # JWT、邮箱、Account ID 需完整匹配 (\Z)，其余只要求前缀匹配
+    _CLASSIFY_RE = re.compile(
+        rf'(?P<jwt>{JWT_PATTERN})\Z'
+        rf'|(?P<email>{EMAIL_PATTERN})\Z'
+        rf'|(?P<account_id>(?ai:{ACCOUNT_ID_PATTERN}))\Z'
+        rf'|(?P<refresh_token>{REFRESH_TOKEN_PATTERN})'
+        rf'|(?P<session_token>{SESSION_TOKEN_PATTERN})'
+        rf'|(?P<client_id>{CLIENT_ID_PATTERN})'
+    )
+
+    # 可能被识别的片段前缀 (JWT/Session Token、Refresh Token、Client ID)
+    _PART_PREFIXES = ("eyJ", "rt-", "app_")
+
+    # 导入行分隔符: ----, |, \t, 以及多个空白
+    _SPLIT_RE = re.compile(r'----|\||\t|\s{2,}')
+
+    # 导入解析结果的字段顺序
+    _RESULT_FIELDS = ("token", "email", "account_id", "refresh_token", "session_token", "client_id")
+
+    # 片段类型 (_CLASSIFY_RE 的 group 名) 对应的字段位置
+    # Session Token 与 JWT 一样先填 token，token 已有时再填 session_token
+    _KIND_INDEX = {
+        "jwt": 0,
+        "email": 1,
+        "account_id": 2,
+        "refresh_token": 3,
+        "session_token": 0,
+        "client_id": 5,
+    }
+
     def extract_jwt_tokens(self, text: str) -> List[str]:
         """
         从文本中提取所有 JWT Token
@@ -41,8 +96,8 @@ class TokenParser:
         Returns:
             JWT Token 列表
         """
-        tokens = re.findall(self.JWT_PATTERN, text)
-        logger.info(f"从文本中提取到 {len(tokens)} 个 JWT Token")
+        tokens = self._JWT_RE.findall(text)
+        logger.info("从文本中提取到 %d 个 JWT Token", len(tokens))
         return tokens
 
     def extract_emails(self, text: str) -> List[str]:
@@ -55,14 +110,40 @@ class TokenParser:
         Returns:
             邮箱地址列表
         """
-        emails = re.findall(self.EMAIL_PATTERN, text)
-        # 过滤掉无效邮箱
-        emails = [email for email in emails if len(email) < 100]
-        # 去重
-        emails = list(set(emails))
-        logger.info(f"从文本中提取到 {len(emails)} 个邮箱地址")
+        # 单次扫描中过滤无效邮箱并去重 (保留首次出现的顺序)
+        emails = []
+        seen = set()
+        for m in self._iter_emails(text):
+            email = m.group()
+            if len(email) < 100 and email not in seen:
+                seen.add(email)
+                emails.append(email)
+        logger.info("从文本中提取到 %d 个邮箱地址", len(emails))
         return emails
 
+    def _iter_emails(self, text: str) -> Iterator[re.Match]:
+        """
+        依次返回文本中的邮箱匹配，耗时与文本长度成线性
+
+        直接 finditer 会在一段本地部分字符 (如不含 @ 的长 Token) 的每个位置都重新尝试匹配。
+        邮箱的本地部分必须是完整的一段字符 (超过 64 位时不会截取后半段作为邮箱)，
+        因此只需在每段的起始位置以及上一个匹配的结束位置尝试。
+        """
+        if "@" not in text:
+            return
+        pos = 0
+        while True:
+            # 上一个匹配的结束位置可能位于一段的中间，单独尝试一次
+            m = self._EMAIL_RE.match(text, pos)
+            if m is None:
+                # 这一段剩下的位置都不可能匹配，从段尾开始查找下一段的起始位置
+                pos = self._EMAIL_LOCAL_RUN_RE.match(text, pos).end()
+                m = self._EMAIL_AT_RUN_START_RE.search(text, pos)
+                if m is None:
+                    return
+            yield m
+            pos = m.end()
+
     def extract_account_ids(self, text: str) -> List[str]:
         """
         从文本中提取所有 Account ID
@@ -73,10 +154,15 @@ class TokenParser:
         Returns:
             Account ID 列表
         """
-        account_ids = re.findall(self.ACCOUNT_ID_PATTERN, text)
-        # 去重
-        account_ids = list(set(account_ids))
-        logger.info(f"从文本中提取到 {len(account_ids)} 个 Account ID")
+        # 单次扫描中去重 (保留首次出现的顺序)
+        account_ids = []
+        seen = set()
+        for m in self._ACCOUNT_ID_RE.finditer(text):
+            account_id = m.group()
+            if account_id not in seen:
+                seen.add(account_id)
+                account_ids.append(account_id)
+        logger.info("从文本中提取到 %d 个 Account ID", len(account_ids))
         return account_ids
 
     def parse_team_import_text(self, text: str) -> List[Dict[str, Optional[str]]]:
@@ -90,80 +176,95 @@ class TokenParser:
         Returns:
             解析结果列表,每个元素包含 token, email, account_id
         """
-        results = []
-
-        # 按行分割文本
-        lines = text.strip().split('\n')
+        results = [dict(zip(self._RESULT_FIELDS, row)) for row in self._iter_rows(text)]
+        logger.info("解析完成,共提取 %d 条 Team 信息", len(results))
+        return results
 
-        for line in lines:
-            line = line.strip()
-            if not line:
+    @staticmethod
+    def _iter_lines(text: str) -> Iterator[str]:
+        """逐行返回去除首尾空白后的非空行，不构造完整的行列表"""
+        start = 0
+        while True:
+            end = text.find("\n", start)
+            line = (text[start:] if end == -1 else text[start:end]).strip()
+            if line:
+                yield line
+            if end == -1:
+                return
+            start = end + 1
+
+    def _iter_rows(self, text: str) -> Iterator[Tuple[Optional[str], ...]]:
+        """逐行解析导入文本，每条结果按 _RESULT_FIELDS 的顺序返回元组"""
+        # 逐片段调用的对象先取到局部变量，避免循环中反复查找类属性
+        classify = self._CLASSIFY_RE.match
+        split_segment = self._SPLIT_RE.split
+        part_prefixes = self._PART_PREFIXES
+        kind_index = self._KIND_INDEX
+        token_index = kind_index["jwt"]
+        session_index = self._RESULT_FIELDS.index("session_token")
+        for line in self._iter_lines(text):
+            # 结果必须包含 token、session_token 或 refresh_token，
+            # 前两者都以 eyJ 开头，后者以 rt- 开头，都不包含的行直接跳过
+            if "eyJ" not in line and "rt-" not in line:
                 continue
 
-            token = None
-            email = None
-            account_id = None
-            refresh_token = None
-            session_token = None
-            client_id = None
-
             # 1. 尝试使用分隔符解析 (支持 ----, | , \t, 以及多个空格)
-            parts = [p.strip() for p in re.split(r'----|\||\t|\s{2,}', line) if p.strip()]
-            
+            # ---- 和 | 先统一替换为 \t 再用 str.split 切分，片段内仍含空白时才交给正则按连续空白切分
+            parts = []
+            for segment in line.replace("----", "\t").replace("|", "\t").split("\t"):
+                segment = segment.strip()
+                if len(segment.split(None, 1)) > 1:
+                    parts.extend(filter(None, map(str.strip, split_segment(segment))))
+                elif segment:
+                    parts.append(segment)
+
+            # 按 _RESULT_FIELDS 的顺序保存各字段
+            row = [None] * len(self._RESULT_FIELDS)
             if len(parts) >= 2:
-                # 根据格式特征自动识别各部分
+                # 根据格式特征自动识别各部分，一次匹配即可确定类型
                 for part in parts:
-                    if not token and re.fullmatch(self.JWT_PATTERN, part):
-                        token = part
-                    elif not email and re.fullmatch(self.EMAIL_PATTERN, part):
-                        email = part
-                    elif not account_id and re.fullmatch(self.ACCOUNT_ID_PATTERN, part, re.IGNORECASE):
-                        account_id = part
-                    elif not refresh_token and re.match(self.REFRESH_TOKEN_PATTERN, part):
-                        refresh_token = part
-                    elif not session_token and re.match(self.SESSION_TOKEN_PATTERN, part):
+                    # 先用字符串判断排除不可能匹配的片段 (邮箱必含 @，Account ID 固定 36 位)
+                    if not (part.startswith(part_prefixes) or "@" in part or len(part) == 36):
+                        continue
+                    m = classify(part)
+                    if not m:
+                        continue
+                    index = kind_index[m.lastgroup]
+                    if index == token_index and row[token_index]:
                         # 如果已经有了 token (JWT)，则第二个匹配 JWT 模式的可能是 session_token
-                        if token:
-                            session_token = part
-                        else:
-                            token = part
-                    elif not client_id and re.match(self.CLIENT_ID_PATTERN, part):
-                        client_id = part
+                        index = session_index
+                    if not row[index]:
+                        row[index] = part
+
+            token, email, account_id, refresh_token, session_token, client_id = row
 
             # 2. 如果结构化解析未找到 Token，尝试全局正则提取结果 (兜底逻辑)
+            # 每种信息只需要第一个匹配 (JWT 需要前两个)，用 search/finditer 找到即停，
+            # 并先用子串判断跳过整行都不可能匹配的类型
             if not token:
-                tokens = re.findall(self.JWT_PATTERN, line)
-                if tokens:
-                    token = tokens[0]
-                    if len(tokens) > 1:
-                        session_token = tokens[1]
-                
+                if "eyJ" in line:
+                    tokens = [m.group() for m in islice(self._JWT_RE.finditer(line), 2)]
+                    if tokens:
+                        token = tokens[0]
+                        if len(tokens) > 1:
+                            session_token = tokens[1]
+
                 # 只有在非结构化情况下才全局提取其他信息
                 if not email:
-                    emails = re.findall(self.EMAIL_PATTERN, line)
-                    email = emails[0] if emails else None
-                if not account_id:
-                    account_ids = re.findall(self.ACCOUNT_ID_PATTERN, line, re.IGNORECASE)
-                    account_id = account_ids[0] if account_ids else None
-                if not refresh_token:
-                    rts = re.findall(self.REFRESH_TOKEN_PATTERN, line)
-                    refresh_token = rts[0] if rts else None
-                if not client_id:
-                    cids = re.findall(self.CLIENT_ID_PATTERN, line)
-                    client_id = cids[0] if cids else None
+                    m = next(self._iter_emails(line), None)
+                    email = m.group() if m else None
+                if not account_id and "-" in line:
+                    m = self._ACCOUNT_ID_ICASE_RE.search(line)
+                    account_id = m.group() if m else None
+                if not refresh_token and "rt-" in line:
+                    m = self._REFRESH_TOKEN_RE.search(line)
+                    refresh_token = m.group() if m else None
+                if not client_id and "app_" in line:
+                    m = self._CLIENT_ID_RE.search(line)
+                    client_id = m.group() if m else None
 
             if token or session_token or refresh_token:
-                results.append({
-                    "token": token,
-                    "email": email,
-                    "account_id": account_id,
-                    "refresh_token": refresh_token,
-                    "session_token": session_token,
-                    "client_id": client_id
-                })
-
-        logger.info(f"解析完成,共提取 {len(results)} 条 Team 信息")
-        return results
+                yield (token, email, account_id, refresh_token, session_token, client_id)
 
     def validate_jwt_format(self, token: str) -> bool:
         """
@@ -175,7 +276,7 @@ class TokenParser:
         Returns:
             True 表示格式正确,False 表示格式错误
         """
-        return bool(re.fullmatch(self.JWT_PATTERN, token))
+        return self._JWT_FULLMATCH(token) is not None
 
     def validate_email_format(self, email: str) -> bool:
         """
@@ -187,7 +288,7 @@ class TokenParser:
         Returns:
             True 表示格式正确,False 表示格式错误
         """
-        return bool(re.fullmatch(self.EMAIL_PATTERN, email))
+        return self._EMAIL_FULLMATCH(email) is not None
 
     def validate_account_id_format(self, account_id: str) -> bool:
         """
@@ -199,7 +300,7 @@ class TokenParser:
         Returns:
             True 表示格式正确,False 表示格式错误
         """
-        return bool(re.fullmatch(self.ACCOUNT_ID_PATTERN, account_id))
+        return self._ACCOUNT_ID_FULLMATCH(account_id) is not None
 
 
 # 创建全局实例
@@ -0,0 +1,70 @@
+"""
+带过期时间和容量上限的内存缓存
+"""
+import time
+from collections import OrderedDict
+from typing import Any, Hashable, Optional, Tuple
+
+
+_MISSING = object()
+
+
+class TTLCache:
+    """
+    固定有效期、有容量上限的内存缓存
+
+    所有条目有效期相同，按写入顺序依次过期，因此只需从头部清理过期条目；
+    超出 maxsize 时淘汰最早写入的条目。计时使用 time.monotonic()，不受系统时钟调整影响。
+    非线程安全，仅供单个事件循环内使用。
+    """
+
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        # key -> (过期时间, 值)，按写入顺序排列
+        self._data: "OrderedDict[Hashable, Tuple[float, Any]]" = OrderedDict()
+
+    def _evict_expired(self, now: float) -> None:
+        """从头部清理已过期的条目"""
+        while self._data:
+            expires_at, _ = next(iter(self._data.values()))
+            if expires_at > now:
+                break
+            self._data.popitem(last=False)
+
+    def get(self, key: Hashable, default: Optional[Any] = None) -> Any:
+        """获取未过期的值，不存在或已过期时返回 default"""
+        item = self._data.get(key)
+        if item is None:
+            return default
+        if item[0] <= time.monotonic():
+            del self._data[key]
+            return default
+        return item[1]
+
+    def set(self, key: Hashable, value: Any) -> None:
+        """写入值并重新计算有效期"""
+        now = time.monotonic()
+        # 先删除再插入，使该键移动到末尾 (最晚过期)
+        self._data.pop(key, None)
+        self._data[key] = (now + self.ttl, value)
+        self._evict_expired(now)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def pop(self, key: Hashable, default: Optional[Any] = None) -> Any:
+        """删除并返回值"""
+        item = self._data.pop(key, None)
+        if item is None or item[0] <= time.monotonic():
+            return default
+        return item[1]
+
+    def clear(self) -> None:
+        self._data.clear()
+
+    def __contains__(self, key: Hashable) -> bool:
+        return self.get(key, _MISSING) is not _MISSING
+
+    def __len__(self) -> int:
+        self._evict_expired(time.monotonic())
+        return len(self._data)
@@ -3,11 +3,11 @@
 创建所有表并插入默认数据
 """
 import asyncio
-import bcrypt
 from sqlalchemy import select
 from app.database import init_db, AsyncSessionLocal
 from app.models import Setting
 from app.config import settings
+from app.services.auth import auth_service
 
 
 async def create_default_settings():
@@ -22,10 +22,7 @@ async def create_default_settings():
             return
 
         # 生成管理员密码哈希
-        password_hash = bcrypt.hashpw(
-            settings.admin_password.encode('utf-8'),
-            bcrypt.gensalt()
-        ).decode('utf-8')
+        password_hash = await auth_service.hash_password(settings.admin_password)
 
         # 默认设置
         default_settings = [
@@ -0,0 +1,96 @@
+"""
+兑换流程并发测试
+运行: python -m unittest discover tests
+"""
+import asyncio
+import os
+import tempfile
+import unittest
+from datetime import timedelta
+from unittest.mock import patch
+
+# 数据库引擎在导入 app 时创建，需在导入前指向临时数据库
+_tmp_dir = tempfile.TemporaryDirectory()
+os.environ["DATABASE_URL"] = f"sqlite+aiosqlite:///{_tmp_dir.name}/test.db"
+
+from sqlalchemy import select, func  # noqa: E402
+
+from app.database import Base, engine, AsyncSessionLocal  # noqa: E402
+from app.models import Team, RedemptionCode, RedemptionRecord  # noqa: E402
+from app.services.encryption import encryption_service  # noqa: E402
+from app.services.redeem_flow import redeem_flow_service  # noqa: E402
+from app.utils.time_utils import get_now  # noqa: E402
+
+
+async def _fake_invite(*args, **kwargs):
+    """模拟邀请请求，留出时间让并发请求交错执行"""
+    await asyncio.sleep(0.05)
+    return {"success": True}
+
+
+class WarrantyReuseConcurrencyTest(unittest.IsolatedAsyncioTestCase):
+    """同一质保码并发重复使用时只能占用一个席位"""
+
+    async def asyncSetUp(self):
+        async with engine.begin() as conn:
+            await conn.run_sync(Base.metadata.drop_all)
+            await conn.run_sync(Base.metadata.create_all)
+
+        now = get_now()
+        access_token = encryption_service.encrypt_token("token")
+        async with AsyncSessionLocal() as session:
+            # 原 Team 已封号，质保码可重复使用
+            session.add(Team(
+                id=1, email="owner@example.com", access_token_encrypted=access_token,
+                account_id="acc-1", team_name="Banned", status="banned",
+                current_members=1, max_members=6, expires_at=now + timedelta(days=30)
+            ))
+            session.add_all([
+                Team(
+                    id=team_id, email="owner@example.com", access_token_encrypted=access_token,
+                    account_id=f"acc-{team_id}", team_name=f"Team {team_id}", status="active",
+                    current_members=0, max_members=6, expires_at=now + timedelta(days=team_id)
+                )
+                for team_id in (2, 3)
+            ])
+            session.add(RedemptionCode(
+                code="WARRANTY", status="warranty_active", has_warranty=True, warranty_days=30,
+                used_by_email="user@example.com", used_team_id=1,
+                used_at=now - timedelta(days=1), warranty_expires_at=now + timedelta(days=29)
+            ))
+            session.add(RedemptionRecord(
+                email="user@example.com", code="WARRANTY", team_id=1, account_id="acc-1",
+                redeemed_at=now - timedelta(days=1) + timedelta(seconds=5),
+                is_warranty_redemption=True
+            ))
+            await session.commit()
+
+    async def asyncTearDown(self):
+        await engine.dispose()
+
+    async def _redeem(self, email: str):
+        async with AsyncSessionLocal() as session:
+            return await redeem_flow_service.redeem_and_join_team(email, "WARRANTY", None, session)
+
+    async def test_concurrent_reuse_claims_once(self):
+        with patch.object(redeem_flow_service.chatgpt_service, "send_invite", _fake_invite):
+            results = await asyncio.gather(
+                self._redeem("user@example.com"),
+                self._redeem("user@example.com")
+            )
+
+        self.assertEqual(sum(1 for r in results if r["success"]), 1)
+
+        async with AsyncSessionLocal() as session:
+            seats = await session.scalar(
+                select(func.sum(Team.current_members)).where(Team.id.in_([2, 3]))
+            )
+            records = await session.scalar(
+                select(func.count(RedemptionRecord.id)).where(RedemptionRecord.code == "WARRANTY")
+            )
+        self.assertEqual(seats, 1)
+        self.assertEqual(records, 2)
+
+
+if __name__ == "__main__":
+    unittest.main()